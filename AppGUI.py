@@ -1,8 +1,21 @@
 import os
+import queue
+import threading
 import tkinter as tk
 from tkinter import filedialog, messagebox, ttk
 from PIL import Image, ImageTk, ImageOps
 import numpy as np
+from ResultsTable import ResultsTable, COLOCALIZATION_COLUMNS
+from CellFeatures import feature_columns
+from RegionOfInterest import RegionOfInterest, rectangle
+from Rendering import to_uint8, label_lut, label_boundaries, composite_layers, render_cache
+
+
+# Time the alpha slider has to be still before the image is redrawn
+REDRAW_DELAY_MS = 15
+
+# How often the viewer checks whether its regions of interest are segmented
+ROI_POLL_MS = 100
 
 
 class SegmentAppGUI:
@@ -18,6 +31,9 @@ class SegmentAppGUI:
 
         self.file_list = None
 
+        # Redraw of the viewer waiting for the slider to stop, see schedule_redraw
+        self.pending_redraw = None
+
 
     def show_startup_screen(self):
         '''Startup Screen with train and run button
@@ -34,7 +50,8 @@ class SegmentAppGUI:
 
 
         train_button = tk.Button(self.root,text="Train New Model", command=self.model_train_screen)
-        run_button = tk.Button(self.root,text="Run an Existing Model", command=self.model_run_screen)
+        # The App decides whether the chosen backend needs a model folder
+        run_button = tk.Button(self.root,text="Run an Existing Model", command=lambda: self.App.select_backend(model_menu.current()))
 
         train_button.grid(row=3,column=0)
         run_button.grid(row=3,column=1)
@@ -93,9 +110,41 @@ class SegmentAppGUI:
                                         command=lambda: self.browse_path(image_dir_entry))
         button_explore.grid(row=1,column=1,pady=10)
 
+        # Keep segmenting the images the microscope writes into the folder
+        watch_folder = tk.BooleanVar(value=False)
+        watch_check = tk.Checkbutton(self.root, text="Watch the folder for new images", variable=watch_folder)
+        watch_check.grid(row=2,pady=5)
+
         # Segment Button 
-        segment_button = tk.Button(self.root, text="Segment Images", command=lambda: self.App.send_images(image_dir_entry.get()))
-        segment_button.grid(row=2,pady=20)
+        segment_button = tk.Button(self.root, text="Segment Images",
+                                   command=lambda: self.App.send_images(image_dir_entry.get(), watch_folder.get()))
+        segment_button.grid(row=3,pady=20)
+
+
+    def model_loading_screen(self, model_name):
+        '''Shown while the model is loaded in the background'''
+
+        self.clear_current_screen()
+
+        loading_label = tk.Label(self.root, text=f"Loading {model_name}")
+        loading_label.grid(row=0,pady=10)
+
+        self.model_loading_progress = ttk.Progressbar(self.root, mode="indeterminate", length=300)
+        self.model_loading_progress.grid(row=1,padx=20,pady=5)
+        self.model_loading_progress.start(10)
+
+        self.model_loading_status = tk.Label(self.root, text="")
+        self.model_loading_status.grid(row=2,pady=10)
+
+
+    def update_model_loading_screen(self, message):
+        '''Shows which step of loading the model is running'''
+
+        self.model_loading_status.config(text=message)
+
+
+    def stop_model_loading_screen(self):
+        self.model_loading_progress.stop()
 
 
     ## HELPER FUNCTIONS FOR GENERAL LOADING SCREENS------
@@ -118,10 +167,10 @@ class SegmentAppGUI:
     
 
 
-    def create_analytics_screen(self, file_list, num_channel, model):
-        '''This funciton is run once when the models run funciton is called.
+    def create_analytics_screen(self, file_list, num_channel, model, watching=False):
+        '''This funciton is run once when the apps run funciton is called.
         Here two global variables are set up referencing the file list of images 
-        and the models instance'''
+        and the models instance. In watch mode the file list grows as images arrive'''
 
         self.model = model
         self.file_list = file_list
@@ -130,26 +179,90 @@ class SegmentAppGUI:
         self.analytics_window = tk.Toplevel(self.root)
         self.analytics_window.title("Image Analysis")
 
-        # List to keep track of row widgets
-        self.row_widgets = []
+        # Rows of the table, the Treeview only shows them
+        self.results_table = ResultsTable(COLOCALIZATION_COLUMNS)
+        # image number -> columns of its cells, replaced when an image is segmented again
+        self.cell_tables = {}
 
-        # Create the top row of the analytics screen
         if self.num_channels != 3:
             messagebox.showerror("Error", f"App Currently Only Supports 3 Channel Images")
 
-        for col in range(4):
-            b = tk.Entry(self.analytics_window, state='normal')
-            b.grid(row = 0, column=col)
-            if col == 0:
-                b.insert(0, "File Name")
-            elif col == 3:
-                b.insert(0, "# cells in electroporated")
-            else:
-                b.insert(0, f"Ratio of electroporated with {col}")
-            # Changing state so the user cannot edit contents of the table
-            b.config(state='readonly')
+        # A single Treeview draws the visible rows, instead of a grid of
+        # Entry widgets that Tk has to lay out for every image
+        table_frame = tk.Frame(self.analytics_window)
+        table_frame.grid(row=0, column=0, sticky='nsew')
+        self.analytics_window.grid_rowconfigure(0, weight=1)
+        self.analytics_window.grid_columnconfigure(0, weight=1)
+
+        self.results_tree = ttk.Treeview(table_frame, columns=COLOCALIZATION_COLUMNS, show='headings', height=20)
+        for col, name in enumerate(COLOCALIZATION_COLUMNS):
+            self.results_tree.heading(name, text=name)
+            self.results_tree.column(name, width=220 if col == 0 else 190, anchor='w' if col == 0 else 'e')
+        self.results_tree.grid(row=0, column=0, sticky='nsew')
+
+        scrollbar = ttk.Scrollbar(table_frame, orient='vertical', command=self.results_tree.yview)
+        scrollbar.grid(row=0, column=1, sticky='ns')
+        self.results_tree.configure(yscrollcommand=scrollbar.set)
+        table_frame.grid_rowconfigure(0, weight=1)
+        table_frame.grid_columnconfigure(0, weight=1)
+
+        # Export every row (and the cell table next to it) in one click
+        export_frame = tk.Frame(self.analytics_window)
+        export_frame.grid(row=1, column=0, pady=5)
+        csv_button = tk.Button(export_frame, text="Export CSV", command=lambda: self.export_results("csv"))
+        csv_button.grid(row=0, column=0, padx=5)
+        parquet_button = tk.Button(export_frame, text="Export Parquet", command=lambda: self.export_results("parquet"))
+        parquet_button.grid(row=0, column=1, padx=5)
+
+        # Progress of the segmentation running in the background, next to the table
+        status_frame = tk.Frame(self.analytics_window)
+        status_frame.grid(row=0, column=1, rowspan=2, sticky='n', padx=10)
+
+        self.segmentation_progress_label = tk.Label(status_frame, text="", justify=tk.LEFT)
+        self.segmentation_progress_label.grid(row=0, column=0, sticky='w')
+        if watching:
+            # The number of images is not known in watch mode
+            self.segmentation_progress = ttk.Progressbar(status_frame, mode="indeterminate", length=250)
+            self.segmentation_progress.start(10)
+            stop_button = tk.Button(status_frame, text="Stop Watching", command=self.stop_watching)
+            stop_button.grid(row=3, column=0, sticky='w')
+        else:
+            self.segmentation_progress = ttk.Progressbar(status_frame, mode="determinate", maximum=len(file_list), length=250)
+        self.segmentation_progress.grid(row=1, column=0, sticky='w', pady=5)
+
+        # Time spent in every stage so far, only when tracing is on
+        self.trace_summary_label = None
+        if self.model.tracer.enabled:
+            self.trace_summary_label = tk.Label(status_frame, text="", font=("Courier", 10), justify=tk.LEFT)
+            self.trace_summary_label.grid(row=2, column=0, sticky='w', pady=10)
   
 
+    def update_segmentation_progress(self, num_segmented, num_reviewed, num_images):
+        '''Shows how many images are segmented and how many of them are ready and
+        waiting for review'''
+
+        # The analysis window may have been closed
+        if not self.analytics_window.winfo_exists():
+            return
+
+        # Watch mode has no total
+        if num_images is None:
+            state = "Watching for new images" if not self.App.worker_finished else "Stopped watching"
+            self.segmentation_progress_label.config(text=f"{state}\nSegmented {num_segmented} images")
+            if self.App.worker_finished:
+                self.segmentation_progress.stop()
+            return
+
+        if num_segmented == num_images:
+            text = f"All {num_images} images segmented"
+        else:
+            text = f"Segmented {num_segmented} of {num_images} images"
+        text += f"\n{num_segmented - num_reviewed} ready for review"
+
+        self.segmentation_progress_label.config(text=text)
+        self.segmentation_progress.config(value=num_segmented)
+
+
     def try_update_analytics_screen(self):
         '''Tries to update the analytics screen, handles the case if the Toplevel window is closed.'''
 
@@ -164,18 +277,18 @@ class SegmentAppGUI:
         if the image only has one channel, or the ratio of colocalizaiton with the 
         electroporated channel'''
 
-        self.clear_current_row()  # Clear the current row before updating
-
         self.electropolated_idx = (int(self.electroporated_channel.get()) - 1)
         marker1_idx, marker2_idx = self.get_marker_idx(self.electropolated_idx)
 
-        self.colocalize1, self.colocalize2 = self.model.count_colocalized_cells(
-                                                        self.segmented_channels[self.electropolated_idx],
-                                                        self.segmented_channels[marker1_idx],
-                                                        self.segmented_channels[marker2_idx])
-        
+        # Look up the counts from the matrix computed when the image arrived
+        self.colocalize1 = self.colocalization_matrix[self.electropolated_idx, marker1_idx]
+        self.colocalize2 = self.colocalization_matrix[self.electropolated_idx, marker2_idx]
+
         self.analytics_screen_colocalize_counts()
 
+        if self.trace_summary_label is not None:
+            self.trace_summary_label.config(text=self.model.tracer.summary())
+
     ## HELPER FUNCTIONS FOR ANALYTICS SCREEN-------
 
     def analytics_screen_colocalize_counts(self):
@@ -184,44 +297,80 @@ class SegmentAppGUI:
 
         # Getting the number of cells in the electerporated channel
         electropolated_details = self.details_list[self.electropolated_idx]
-        num_electropolated = electropolated_details['points'].size
-
-        # Storing the widgets in each row in case they need to be
-        # updated (user selects different channel as enterporolated)
-        row_widgets = []
-
-        #Adding the items to the table
-        for col in range(4):
-            b = tk.Entry(self.analytics_window, state='normal')
-            b.grid(row = self.model.img_count, column= col)
-            row_widgets.append(b)
-            if col == 0:
-                image_name = os.path.basename(self.file_list[self.model.img_count - 1])
-                b.insert(0, f"{image_name}")
-            elif col == 1:
-                coloc1 = self.colocalize1 / num_electropolated
-                b.insert(0,np.round(coloc1,2))
-            elif col == 2:
-                coloc2 = self.colocalize2 / num_electropolated
-                b.insert(0, np.round(coloc2,2))
-            else:
-                b.insert(0, num_electropolated)
+        # points has shape (n_cells, 2), so count the rows rather than the size
+        num_electropolated = len(electropolated_details['points'])
+
+        coloc1, coloc2 = 0.0, 0.0
+        if num_electropolated > 0:
+            coloc1 = self.colocalize1 / num_electropolated
+            coloc2 = self.colocalize2 / num_electropolated
+
+        image_name = os.path.basename(self.file_list[self.App.img_count - 1])
+        values = [image_name, float(np.round(coloc1, 2)), float(np.round(coloc2, 2)), num_electropolated]
 
-            b.config(state='readonly')
+        # The row of the current image is replaced when the user
+        # selects a different channel as enterporolated
+        self.set_analytics_row(self.App.img_count, values)
 
-            # Adding widgets from current row to the list
-            self.row_widgets.append(row_widgets)
 
+    def set_analytics_row(self, img_count, values):
+        '''Adds the row of an image to the table, or replaces it'''
+
+        self.results_table.set_row(img_count, values)
+        row_id = str(img_count)
+        if self.results_tree.exists(row_id):
+            self.results_tree.item(row_id, values=values)
+        else:
+            self.results_tree.insert('', 'end', iid=row_id, values=values)
+            self.results_tree.see(row_id)
+
+
+    def add_watched_result(self, img_count, row, cells):
+        '''Adds an image to the table as soon as it is segmented in watch mode, with the
+        viewer's default electroporated channel, before it is reviewed'''
+
+        # The analysis window may have been closed
+        if not self.analytics_window.winfo_exists():
+            return
+
+        self.set_analytics_row(img_count, [row[0], float(row[1]), float(row[2]), int(row[3])])
+        self.cell_tables[img_count] = cells
+
+
+    def stop_watching(self):
+        '''Stops watch mode once the image being segmented is done'''
+
+        self.App.stop_watching.set()
 
-    def clear_current_row(self):
-        '''Clears current row in analytics screen IF the row has been created, then
-        deletes the rows widgets from the stored widget list'''
 
-        if len(self.row_widgets) == self.model.img_count:  # Ensure there is a row to clear
-            current_row_widgets = self.row_widgets[-1]
-            for widget in current_row_widgets:
-                widget.destroy()
-            self.row_widgets.pop()
+    def export_results(self, file_format):
+        '''Saves every row of the analysis table, and a table with every cell of every
+        image next to it as <name>_cells'''
+
+        file_path = filedialog.asksaveasfilename(defaultextension=f".{file_format}",
+                                                 initialfile=f"colocalization.{file_format}",
+                                                 filetypes=[(file_format.upper(), f"*.{file_format}")])
+        if not file_path:
+            return
+
+        cell_table = ResultsTable(feature_columns(self.num_channels))
+        for img_count in sorted(self.cell_tables):
+            cell_table.extend(self.cell_tables[img_count])
+
+        cells_path = f"{os.path.splitext(file_path)[0]}_cells.{file_format}"
+        try:
+            if file_format == "csv":
+                self.results_table.to_csv(file_path)
+                cell_table.to_csv(cells_path)
+            else:
+                self.results_table.to_parquet(file_path)
+                cell_table.to_parquet(cells_path)
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to export results: {e}")
+            return
+
+        messagebox.showinfo("Exported", f"Saved {len(self.results_table)} images to {file_path}\n"
+                                        f"and {len(cell_table)} cells to {cells_path}")
 
 
     def get_marker_idx(self, electropolated_idx):
@@ -243,10 +392,15 @@ class SegmentAppGUI:
             
 
 
-    def labels_view_screen(self, original_image, segmented_channels: list[np.ndarray], details):
+    def labels_view_screen(self, original_image, segmented_channels: list[np.ndarray], details, colocalization_matrix=None,
+                           cells=None):
         '''Creates an image view screen with options to select the electropolated channel,
         options to save the image and to go to the next image, and display the image itself 
-        with the selected options applied'''
+        with the selected options applied. cells is the cell table of the image, measured
+        by the worker that segmented it (in watch mode it is already in the table)'''
+
+        if cells is not None:
+            self.cell_tables[self.App.img_count] = cells
 
         #Creates a new screen to display said options and image
         new_window = tk.Toplevel(self.root)
@@ -254,12 +408,34 @@ class SegmentAppGUI:
 
         #Getting the original image
         self.current_image = original_image
+        # One 2D integer label image per channel
         self.segmented_channels = segmented_channels
         self.details_list = details
+
+        # Colocalization between every pair of channels, so changing the
+        # electroporated channel only has to look the counts up
+        if colocalization_matrix is None:
+            colocalization_matrix = self.model.colocalization_matrix(segmented_channels)
+        self.colocalization_matrix = colocalization_matrix
+
         self.selected_channels = [tk.BooleanVar(value=True) for _ in segmented_channels]
+        # Draw the outline of every cell instead of filling it, keeps dense nuclei apart
+        self.show_outlines = tk.BooleanVar(value=False)
+
+        # Largest label of each channel, the size of its color lookup table
+        self.max_labels = [int(labels.max(initial=0)) for labels in segmented_channels]
+        # A redraw scheduled for the previous image must not run on this one
+        self.cancel_redraw()
 
         self.current_viewer_window = new_window
 
+        # Regions drawn on this image, starting from the ones the image was segmented with
+        self.viewer_rois = list(self.model.rois_for(self.file_list[self.App.img_count - 1]))
+        self.roi_start = None
+        self.polygon_vertices = []
+        # Closing the window moves on to the next image like the Next Image button
+        new_window.protocol("WM_DELETE_WINDOW", self.next_image)
+
         # Creating a frame inside the viewer to place the electropolated 
         # channel label and options
         electroporated_frame = tk.Frame(new_window)
@@ -306,9 +482,17 @@ class SegmentAppGUI:
         self.alpha_slider.set(0.3) # See the get_alpha function for details on alpha configuration
         self.alpha_slider.bind("<ButtonRelease-1>", lambda event: self.get_alpha)
 
+        # Regions of interest are drawn with the left mouse button, a rectangle by
+        # dragging and a polygon by clicking its corners and double clicking to close it
+        self.canvas.bind("<ButtonPress-1>", self.roi_press)
+        self.canvas.bind("<B1-Motion>", self.roi_drag)
+        self.canvas.bind("<ButtonRelease-1>", self.roi_release)
+        self.canvas.bind("<Double-Button-1>", self.roi_close_polygon)
+
         # Force the canvas to update its size before displaying the image
         new_window.update_idletasks()
 
+        self.build_render_cache()
         self.update_image_display()
         self.try_update_analytics_screen()
 
@@ -321,6 +505,9 @@ class SegmentAppGUI:
             chk = tk.Checkbutton(control_frame, text=f"Channel {i+1}", variable=var, command=self.update_image_display)
             chk.grid(row=0, column=i)
 
+        outline_check = tk.Checkbutton(control_frame, text="Outlines", variable=self.show_outlines, command=self.update_image_display)
+        outline_check.grid(row=0, column=len(self.selected_channels))
+
         # Save button
         save_button = tk.Button(control_frame, text="Save Image", command=self.save_image)
         save_button.grid(row=1, column=0, columnspan=2)
@@ -329,81 +516,246 @@ class SegmentAppGUI:
         next_button = tk.Button(control_frame, text="Next Image", command=self.next_image)
         next_button.grid(row=1, column=2, columnspan=2)
 
+        # Regions of interest
+        roi_frame = tk.Frame(new_window)
+        roi_frame.grid(row=3, column=0, columnspan=4)
+
+        self.roi_mode = tk.StringVar(value="rectangle")
+        tk.Radiobutton(roi_frame, text="Rectangle", variable=self.roi_mode, value="rectangle",
+                       command=self.cancel_polygon).grid(row=0, column=0)
+        tk.Radiobutton(roi_frame, text="Polygon", variable=self.roi_mode, value="polygon",
+                       command=self.cancel_polygon).grid(row=0, column=1)
+
+        clear_button = tk.Button(roi_frame, text="Clear ROIs", command=self.clear_rois)
+        clear_button.grid(row=0, column=2)
+
+        self.segment_rois_button = tk.Button(roi_frame, text="Segment ROIs", command=self.segment_viewer_rois)
+        self.segment_rois_button.grid(row=0, column=3)
+
+        # Images that were not segmented yet use the same regions
+        self.use_rois_for_next = tk.BooleanVar(value="*" in self.model.rois)
+        roi_next_check = tk.Checkbutton(roi_frame, text="Use ROIs for the next images",
+                                        variable=self.use_rois_for_next, command=self.apply_rois_to_next)
+        roi_next_check.grid(row=1, column=0, columnspan=4)
+
 
     def update_image_display(self):
         '''Updates the image in the viewer when user toggles channels to be
-        viewed'''
+        viewed. Only the layers cached at the canvas size are composited'''
+
+        self.cancel_redraw()
 
         # Clear the canvas before updating
         self.canvas.delete("all")
 
-        # If no channels are selected, self.combined_image wil just be a 2D array with zeros (black screen)
-        num_channels_selected = self.get_selected_channel_count()
-        target_shape = self.current_image.shape
+        selected = [var.get() for var in self.selected_channels]
+        outlines = self.display_outlines if self.show_outlines.get() else None
+        with self.model.tracer.span("update_image_display") as span:
+            background_image = composite_layers(self.display_gray, self.display_labels, selected, self.label_luts, outlines)
+            span.arrays(composite=background_image)
 
-        # This creates the GRAYSCALE BACKGROUND image to be displayed behind the labels for selected channels
-        if num_channels_selected == 0:
-            # If no channels are selected, show a black screen
-            self.combined_image = np.zeros((target_shape[0], target_shape[1], 3))
+        background_image = Image.fromarray(background_image)
+        background_image_tk = ImageTk.PhotoImage(background_image)
+
+        self.canvas.create_image(0, 0, anchor=tk.NW, image=background_image_tk)
+        self.canvas.image = background_image_tk
+        self.draw_rois()
+
+
+    def build_render_cache(self):
+        '''Downsamples the grayscale image and the labels of every channel to the
+        canvas size once per image, so a redraw only composites small uint8 layers'''
+
+        canvas_width = max(1, self.canvas.winfo_width())
+        canvas_height = max(1, self.canvas.winfo_height())
+
+        self.display_gray, self.display_labels, self.display_outlines = render_cache(
+            self.current_image, self.segmented_channels, canvas_width, canvas_height)
+
+        # Image pixels per canvas pixel in x and y, to map mouse positions to the image
+        height, width = self.current_image.shape[:2]
+        self.display_scale = (width / canvas_width, height / canvas_height)
+
+
+    def schedule_redraw(self):
+        '''Redraws the image once the slider has stopped moving for a moment, 
+        instead of on every slider event'''
+
+        self.cancel_redraw()
+        self.pending_redraw = self.root.after(REDRAW_DELAY_MS, self.update_image_display)
+
+
+    def cancel_redraw(self):
+        '''Drops the scheduled redraw, if there is one'''
+
+        if self.pending_redraw is not None:
+            self.root.after_cancel(self.pending_redraw)
+            self.pending_redraw = None
+
+
+    ## REGIONS OF INTEREST---------
+    def canvas_to_image(self, x, y):
+        '''Image (x, y) pixel of a canvas position'''
+
+        return x * self.display_scale[0], y * self.display_scale[1]
+
+
+    def roi_press(self, event):
+        x, y = self.canvas_to_image(event.x, event.y)
+        if self.roi_mode.get() == "rectangle":
+            self.roi_start = (x, y)
         else:
-            # Combine selected channels into a single image
-            self.combined_image = np.zeros((target_shape[0], target_shape[1], num_channels_selected))
-            channel_idx = 0
-            for i, var in enumerate(self.selected_channels):
-                if var.get():
-                    self.combined_image[:,:,channel_idx] = self.current_image[:,:,i]
-                    channel_idx += 1
-        
-       
-        # Convert the combined image to grayscale and make them three channels
-        grayscale_image = np.mean(self.combined_image, axis=-1) if self.combined_image.ndim == 3 else self.combined_image
-        grayscale_image = np.stack([grayscale_image] * 3, axis=-1)
-
-        # Combine original image and selected segmented channels
-        background_image = grayscale_image.copy()
-
-        # Performig bitwise operation if there are multiple labels to show the overlap
-        if num_channels_selected > 1:
-            overlap_image = np.zeros((target_shape[0], target_shape[1], 3))
-            initial_overlap = np.ones((target_shape[0], target_shape[1]))
-    
-        for i, var in enumerate(self.selected_channels):
-            if var.get():
-                segmented_channel = self.segmented_channels[i]
+            self.polygon_vertices.append((x, y))
+            self.draw_rois()
 
-                # Performing bitwise operation to create overlap image
-                if num_channels_selected > 1:
-                    initial_overlap = (segmented_channel[:,:,i] > 0) & (initial_overlap > 0)
 
-                background_image = background_image + (self.alpha * segmented_channel)
-        
-        if num_channels_selected > 1:
-            # Creating a gold three channel image of the overlaps
-            overlap_image[:,:,0] = initial_overlap
-            overlap_image[:,:,1] = initial_overlap * 0.85
+    def roi_drag(self, event):
+        '''Outlines the rectangle being dragged'''
 
-            background_image += overlap_image
+        if self.roi_mode.get() != "rectangle" or self.roi_start is None:
+            return
 
-        background_image = np.clip(background_image, 0, 1)
-        # Changing the array into an image
-        background_image = (background_image * 255).astype(np.uint8)
+        start_x = self.roi_start[0] / self.display_scale[0]
+        start_y = self.roi_start[1] / self.display_scale[1]
+        self.canvas.delete("roi_drag")
+        self.canvas.create_rectangle(start_x, start_y, event.x, event.y, outline="cyan", dash=(4, 2), tags="roi_drag")
 
-        # Creating an image of what is currently displayed 
-        # in case the user wants to save it
-        self.image_to_save = background_image
 
-        background_image = Image.fromarray(background_image)
+    def roi_release(self, event):
+        if self.roi_mode.get() != "rectangle" or self.roi_start is None:
+            return
 
-        # Get the current canvas size
-        canvas_width = self.canvas.winfo_width()
-        canvas_height = self.canvas.winfo_height()
-        
-        # Resize the image to fit the canvas
-        background_image = background_image.resize((canvas_width, canvas_height), Image.LANCZOS)
-        background_image_tk = ImageTk.PhotoImage(background_image)
+        x, y = self.canvas_to_image(event.x, event.y)
+        start_x, start_y = self.roi_start
+        self.roi_start = None
+        self.canvas.delete("roi_drag")
 
-        self.canvas.create_image(0, 0, anchor=tk.NW, image=background_image_tk)
-        self.canvas.image = background_image_tk
+        # A click without a drag is not a region
+        if abs(x - start_x) < 2 or abs(y - start_y) < 2:
+            return
+
+        self.viewer_rois.append(rectangle(min(x, start_x), min(y, start_y), max(x, start_x), max(y, start_y)))
+        self.draw_rois()
+
+
+    def roi_close_polygon(self, event):
+        '''Finishes the polygon being drawn. The second click of the double click
+        already added a corner, so repeated corners are dropped'''
+
+        if self.roi_mode.get() != "polygon":
+            return
+
+        vertices = [vertex for i, vertex in enumerate(self.polygon_vertices)
+                    if i == 0 or vertex != self.polygon_vertices[i - 1]]
+        if len(vertices) >= 3:
+            self.viewer_rois.append(RegionOfInterest(vertices))
+            self.polygon_vertices = []
+            self.draw_rois()
+
+
+    def cancel_polygon(self):
+        self.polygon_vertices = []
+        self.draw_rois()
+
+
+    def clear_rois(self):
+        self.viewer_rois = []
+        self.cancel_polygon()
+        self.apply_rois_to_next()
+
+
+    def draw_rois(self):
+        '''Draws the regions and the unfinished polygon over the image'''
+
+        self.canvas.delete("roi")
+        scale_x, scale_y = self.display_scale
+
+        for roi in self.viewer_rois:
+            points = (roi.vertices / (scale_x, scale_y)).ravel().tolist()
+            self.canvas.create_polygon(points, outline="cyan", fill="", width=2, tags="roi")
+
+        if self.polygon_vertices:
+            points = (np.asarray(self.polygon_vertices) / (scale_x, scale_y)).ravel().tolist()
+            if len(self.polygon_vertices) > 1:
+                self.canvas.create_line(points, fill="cyan", dash=(4, 2), tags="roi")
+            for x, y in zip(points[::2], points[1::2]):
+                self.canvas.create_oval(x - 2, y - 2, x + 2, y + 2, outline="cyan", tags="roi")
+
+
+    def apply_rois_to_next(self):
+        '''Sets the regions the model uses for the images it has not segmented yet.
+        Images already segmented in the background keep their whole image results'''
+
+        if self.use_rois_for_next.get() and self.viewer_rois:
+            self.model.rois["*"] = list(self.viewer_rois)
+        else:
+            self.model.rois.pop("*", None)
+
+
+    def segment_viewer_rois(self):
+        '''Segments the current image again inside the drawn regions only, and
+        replaces its labels and its row of the analysis table. The model runs on a
+        background thread so the window keeps responding, it waits for the image the
+        worker is segmenting to finish first'''
+
+        if not self.viewer_rois:
+            messagebox.showinfo("No ROIs", "Draw a rectangle or polygon on the image first")
+            return
+
+        self.current_viewer_window.config(cursor="watch")
+        self.segment_rois_button.config(state=tk.DISABLED)
+
+        # The result is only used by the viewer window it was started from
+        job = dict(window=self.current_viewer_window, image=self.current_image,
+                   file_path=self.file_list[self.App.img_count - 1],
+                   rois=list(self.viewer_rois), results=queue.Queue(maxsize=1))
+        threading.Thread(target=self.roi_worker, args=(job,), daemon=True).start()
+        self.root.after(ROI_POLL_MS, self.collect_viewer_rois, job)
+
+
+    def roi_worker(self, job):
+        '''Runs on the background thread, puts the segmented regions or the error on
+        the queue of the job'''
+
+        try:
+            segmented_channels, details_list = self.model.segment_rois(job['image'], job['rois'])
+            matrix = self.model.colocalization_matrix(segmented_channels)
+            cells = self.model.measure_cells(job['file_path'], segmented_channels, details_list)
+        except Exception as e:
+            job['results'].put(("error", e))
+            return
+
+        job['results'].put(("result", (segmented_channels, details_list, matrix, cells)))
+
+
+    def collect_viewer_rois(self, job):
+        '''Shows the segmented regions once the background thread is done with them'''
+
+        try:
+            kind, value = job['results'].get_nowait()
+        except queue.Empty:
+            self.root.after(ROI_POLL_MS, self.collect_viewer_rois, job)
+            return
+
+        # The user moved on to the next image or closed the viewer in the meantime
+        if job['window'] is not self.current_viewer_window or not job['window'].winfo_exists():
+            return
+
+        self.current_viewer_window.config(cursor="")
+        self.segment_rois_button.config(state=tk.NORMAL)
+        if kind == "error":
+            messagebox.showerror("Error", f"Failed to segment the regions of interest: {value}")
+            return
+
+        self.segmented_channels, self.details_list, self.colocalization_matrix, cells = value
+        self.cell_tables[self.App.img_count] = cells
+        self.max_labels = [int(labels.max(initial=0)) for labels in self.segmented_channels]
+        self.label_luts = [label_lut(self.alpha, max_label) for max_label in self.max_labels]
+
+        self.build_render_cache()
+        self.update_image_display()
+        self.try_update_analytics_screen()
+        self.apply_rois_to_next()
 
 
     ## HELPER FUNCTIONS FOR IMAGE VIEWER---------
@@ -413,13 +765,14 @@ class SegmentAppGUI:
         the top. We also move the value in the range of 0 to 0.02 since that is what 
         makes an effect when added on to the original image'''
         
-            try:
-                self.alpha = self.alpha_slider.get()
-            except:
-                self.alpha = 0.3
-            
-            self.alpha = (1 - self.alpha) * 0.02
-            self.update_image_display()
+        try:
+            self.alpha = self.alpha_slider.get()
+        except:
+            self.alpha = 0.3
+        
+        self.alpha = (1 - self.alpha) * 0.02
+        self.label_luts = [label_lut(self.alpha, max_label) for max_label in self.max_labels]
+        self.schedule_redraw()
     
     def get_selected_channel_count(self):
         '''Gets the number of channels user has selected to view in viewer'''
@@ -429,13 +782,15 @@ class SegmentAppGUI:
     
 
     def next_image(self):
-        '''Closes the current image viewer which promts the loop in 
-        run funciton of the CustomStarDistFile.py to continue to next
-        image'''
+        '''Closes the current image viewer and shows the next image, which the
+        model has usually segmented in the background by now'''
+
+        # A redraw scheduled by the slider would draw on the destroyed canvas
+        self.cancel_redraw()
 
         # Close the current viewer window
         self.current_viewer_window.destroy()
-        # Model will now the next image
+        self.App.show_next_result()
 
 
     def save_image(self):
@@ -443,5 +798,13 @@ class SegmentAppGUI:
         
         file_path = filedialog.asksaveasfilename(defaultextension=".png", filetypes=[("PNG files", "*.png"), ("All files", "*.*")])
         if file_path:
-            Image.fromarray(self.image_to_save).save(file_path)
+            # The saved image is composited at full resolution
+            selected = [var.get() for var in self.selected_channels]
+            gray_layers = to_uint8(self.current_image)
+            outlines = None
+            if self.show_outlines.get():
+                outlines = [label_boundaries(labels) for labels in self.segmented_channels]
+            image_to_save = composite_layers([gray_layers[:,:,i] for i in range(len(self.segmented_channels))],
+                                             self.segmented_channels, selected, self.label_luts, outlines)
+            Image.fromarray(image_to_save).save(file_path)
             messagebox.showinfo("Image Saved", f"Image saved to {file_path}")
@@ -1,10 +1,388 @@
+import os
+import importlib
+import threading
 from abc import ABC, abstractmethod
+from collections import deque
+from itertools import chain, islice
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from tifffile import imread
+from Normalization import normalize_percentile
+from Colocalization import colocalize, colocalization_matrix
+from ResultsCache import ResultsCache
+from Instrumentation import Tracer
+from RegionOfInterest import crop_windows, inside_any
+from CellFeatures import cell_features
+
+
+# Segmentation backends, by the short name used on the command line. Only the module
+# and class are stored so a backend's dependencies (such as TensorFlow) are imported
+# when it is chosen and not when the app starts
+MODEL_BACKENDS = {}
+
+
+def register_backend(name, display_name, module_name, class_name, needs_model_path=True, options=()):
+    '''Adds a backend to the model menu and the command line. Backends without
+    model files are built without a model path. options are the keyword arguments
+    the backend takes on top of the ones every backend takes, the command line
+    rejects the others'''
+
+    MODEL_BACKENDS[name] = dict(display_name=display_name,
+                                module_name=module_name,
+                                class_name=class_name,
+                                needs_model_path=needs_model_path,
+                                options=tuple(options))
+
+
+def get_backend(name):
+    '''Imports and returns the class of a registered backend'''
+
+    backend = MODEL_BACKENDS[name]
+    return getattr(importlib.import_module(backend['module_name']), backend['class_name'])
+
+
+def create_model(name, model_path=None, **options):
+    '''Builds a backend. The model path is split into the folder and name of the
+    model the same way for every backend that needs one'''
+
+    model_class = get_backend(name)
+    if not MODEL_BACKENDS[name]['needs_model_path']:
+        return model_class(**options)
+
+    model_path = os.path.normpath(model_path)
+    return model_class(os.path.basename(model_path), os.path.dirname(model_path), **options)
+
+
+register_backend("stardist", "Custom StarDist Model", "CustomStarDistFile", "CustomStarDist",
+                 options=("batch_size", "postprocess_workers", "tile_memory_mb", "autotune_tiles",
+                          "tflite_model", "intra_op_threads", "inter_op_threads"))
+register_backend("classical", "Classical Watershed (Fast Preview)", "ClassicalSegmentation", "ClassicalWatershed",
+                 needs_model_path=False)
+
 
 class BaseModel(ABC):
+    '''Everything around the segmentation itself that every backend shares: reading
+    and normalizing the images, the results cache and the colocalization. The run
+    modes that drive a model are in BatchPipeline.py and MainApp.py. A backend implements segment_channels and settings_fingerprint'''
+
+    def __init__(self, lookahead=2, prefetch_workers=1, normalize_subsample=1,
+                 batch_size=1, min_overlap=1, min_iou=0.0, trace_path=None):
+        # Number of prepared images that are held ahead of the one being segmented
+        # (queue depth), and the number of threads preparing them (0 reads inline)
+        self.lookahead = max(1, lookahead)
+        self.prefetch_workers = prefetch_workers
+
+        # Percentiles mapped to 0 and 1 by the normalization, only every n-th row
+        # and column is used to find them
+        self.normalize_percentiles = (1, 99.8)
+        self.normalize_subsample = normalize_subsample
+
+        # Number of single channel inputs segmented together, capped by the backend
+        max_batch_size = self.capabilities()['max_batch_size']
+        self.batch_size = max(1, batch_size if max_batch_size is None else min(batch_size, max_batch_size))
+
+        # An electroporated and a marker cell only colocalize when they overlap by at
+        # least min_overlap pixels and their intersection over union is at least min_iou
+        self.min_overlap = min_overlap
+        self.min_iou = min_iou
+
+        self.results_cache = None
+
+        # Regions of interest by image file name, the regions under "*" are used for
+        # every image that is not listed. Images without regions are segmented whole.
+        # roi_padding pixels around each region are segmented too, so cells on its
+        # edge are not cut off
+        self.rois = {}
+        self.roi_padding = 32
+        # Crops start on multiples of this many pixels, see crop_windows
+        self.roi_alignment = 1
+
+        # Held while the model segments, so the app's background worker and a
+        # viewer segmenting regions of interest take turns. Reentrant because
+        # segment_stream calls segment_rois
+        self.inference_lock = threading.RLock()
+
+        # Timing and memory of every stage are written to trace_path as JSON lines,
+        # with no trace_path the instrumented calls do nothing
+        self.tracer = Tracer(trace_path)
+
+
+    def init_results_cache(self, cache_directory, cache_size_mb=2048):
+        '''Results of images that were already segmented with the same settings are
+        loaded from disk instead of being segmented again. Called by the backend once
+        every setting in its fingerprint is set'''
+
+        if cache_directory is not None:
+            self.results_cache = ResultsCache(cache_directory, self.settings_fingerprint(), cache_size_mb)
+
+
+    def capabilities(self):
+        '''What the backend supports. max_batch_size is the largest number of single
+        channel inputs segmented together (None for no limit), tiling is whether large
+        images are split into tiles and large_images is whether segment_large_directory
+        is available'''
+
+        return dict(max_batch_size=1, tiling=False, large_images=False)
+
+
     @abstractmethod
-    def load_images(self, *args, **kwargs):
+    def segment_channels(self, img: np.ndarray):
+        '''Returns a list of label images and a list of details dictionaries (with at
+        least points and prob for every cell), one per channel of a normalized image'''
         pass
 
+
     @abstractmethod
-    def segment_channels(self, *args, **kwargs):
+    def settings_fingerprint(self):
+        '''Text describing every setting that changes the results, used as part of
+        the results cache key'''
         pass
+
+
+    def segment_arrays(self, images: list[np.ndarray]):
+        '''Segments one or many normalized images, returns a (label list, details list)
+        for each. Backends that can run several images at once override this'''
+
+        return [self.segment_channels(img) for img in images]
+
+
+    def warm_up(self):
+        '''Runs anything that is slow the first time (such as setting up a network)
+        before the first image is segmented'''
+        pass
+
+
+    def close(self):
+        '''Releases anything the backend holds on to, such as worker processes'''
+
+        self.tracer.close()
+
+
+    def iter_images(self, file_list):
+        '''Yields (file path, normalized image) one image at a time, so only
+        the images inside the look-ahead window are held in memory. When
+        prefetch_workers > 0 the images in the window are read and normalized
+        on background threads while the current image is being segmented'''
+
+        if self.prefetch_workers == 0:
+            pending = deque()
+            for file_path in file_list:
+                pending.append((file_path, self.prepare_image(file_path)))
+                if len(pending) >= self.lookahead:
+                    yield pending.popleft()
+
+            while pending:
+                yield pending.popleft()
+            return
+
+        # tifffile decoding and the numpy percentile calls release the GIL, so
+        # threads are enough to overlap them with inference
+        executor = ThreadPoolExecutor(max_workers=self.prefetch_workers)
+        try:
+            files = iter(file_list)
+            pending = deque((file_path, executor.submit(self.prepare_image, file_path))
+                            for file_path in islice(files, self.lookahead))
+
+            while pending:
+                file_path, future = pending.popleft()
+                # Queue up the next image before handing this one to the model
+                next_path = next(files, None)
+                if next_path is not None:
+                    pending.append((next_path, executor.submit(self.prepare_image, next_path)))
+
+                yield file_path, future.result()
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+    def prepare_image(self, file_path):
+        '''Reads a single image, moves its color channel last and normalizes it'''
+
+        image_name = os.path.basename(file_path)
+        img = self.read_image(file_path)
+
+        with self.tracer.span("normalize_image", image=image_name) as span:
+            img = self.normalize_image(img)
+            span.arrays(normalized=img)
+
+        return img
+
+
+    def read_image(self, file_path):
+        '''Reads a single image and moves its color channel last, without normalizing it'''
+
+        with self.tracer.span("read_image", image=os.path.basename(file_path)) as span:
+            img = imread(file_path)
+            span.arrays(image=img)
+
+        if img.shape[0] == 3:
+            img = self.adjust_image_channels(img)
+
+        return img
+
+
+    def adjust_image_channels(self, img):
+        '''Moves color channel last, from (C, W, H) to (W, H, C)'''
+
+        return np.moveaxis(img, 0, -1)
+
+
+    def normalize_image(self, img):
+        '''Normalizes each channel of an image independently before being passed 
+        throught the model'''
+
+        return normalize_percentile(img, *self.normalize_percentiles, subsample=self.normalize_subsample)
+
+
+    def start_image_stream(self, file_list):
+        '''Starts streaming the images and reads the first one to get the number
+        of channels. Returns the stream with the first image put back in front'''
+
+        images = self.iter_images(file_list)
+        first = next(images)
+        img = first[1]
+        self.n_channel = 1 if img.ndim == 2 else img.shape[-1]
+        if self.n_channel > 1:
+            print("Normalizing image channels independently.")
+
+        return chain([first], images)
+
+
+    def segment_stream(self, images):
+        '''Takes a stream of (file path, image) and yields (file path, image, label
+        list, details list, colocalization matrix). Images that are in the results 
+        cache are not segmented again. When batch_size > 1 enough images are collected
+        to fill a batch and they are passed to segment_arrays together'''
+
+        group_size = 1 if self.batch_size == 1 else max(1, self.batch_size // self.n_channel)
+
+        images = iter(images)
+        while True:
+            group = list(islice(images, group_size))
+            if len(group) == 0:
+                return
+
+            keys = [None] * len(group)
+            cached = [None] * len(group)
+            if self.results_cache is not None:
+                with self.tracer.span("results_cache_lookup", images=len(group)):
+                    # The regions of interest change the result, so they are part of the key
+                    keys = [self.results_cache.image_key(file_path, self.roi_key(file_path)) for file_path, _ in group]
+                    cached = [self.results_cache.load(key) for key in keys]
+
+            # Only the images missing from the cache go through the model
+            missing = [(file_path, img) for (file_path, img), result in zip(group, cached) if result is None]
+            with self.inference_lock, self.tracer.span("segment_channels", images=[os.path.basename(file_path) for file_path, _ in missing]):
+                # Images with regions of interest only have their regions segmented
+                whole = [img for file_path, img in missing if not self.rois_for(file_path)]
+                segmented_whole = iter(self.segment_arrays(whole) if whole else [])
+                segmented = iter([self.segment_rois(img, self.rois_for(file_path)) if self.rois_for(file_path)
+                                  else next(segmented_whole) for file_path, img in missing])
+
+            for (file_path, img), key, result in zip(group, keys, cached):
+                if result is None:
+                    image_list, details_list = next(segmented)
+                    with self.tracer.span("colocalization", image=os.path.basename(file_path)) as span:
+                        matrix = self.colocalization_matrix(image_list)
+                        span.arrays(**{f'labels_{c}': labels for c, labels in enumerate(image_list)})
+                    if key is not None:
+                        self.results_cache.save(key, image_list, details_list, matrix)
+                else:
+                    image_list, details_list, matrix = result
+
+                yield file_path, img, image_list, details_list, matrix
+
+
+    def rois_for(self, file_path):
+        '''Regions of interest of an image, an empty list to segment the whole image'''
+
+        return self.rois.get(os.path.basename(file_path), self.rois.get("*", []))
+
+
+    def roi_key(self, file_path):
+        '''Text describing the regions of interest of an image for the results cache
+        key, empty when the whole image is segmented'''
+
+        rois = self.rois_for(file_path)
+        if len(rois) == 0:
+            return ""
+        return f"{rois!r} padding={self.roi_padding}"
+
+
+    def segment_rois(self, img: np.ndarray, rois):
+        '''Segments only padded crops around the regions of interest of an image. The
+        cells with their center inside a region are pasted into full size label images,
+        and their details are moved to full image coordinates, so the result can be used
+        like the one of segment_channels'''
+
+        from PostProcessing import compact_labels
+
+        height, width, num_channels = img.shape
+        full_labels = [np.zeros((height, width), dtype=np.int32) for _ in range(num_channels)]
+        kept = [[] for _ in range(num_channels)]
+
+        with self.inference_lock:
+            for top, left, bottom, right in crop_windows(rois, (height, width), self.roi_padding, self.roi_alignment):
+                crop_labels, crop_details = self.segment_channels(np.ascontiguousarray(img[top:bottom, left:right]))
+
+                for channel in range(num_channels):
+                    details = crop_details[channel]
+                    offset = np.array([top, left])
+                    points = np.asarray(details['points']).reshape(-1, 2) + offset
+                    inside = inside_any(rois, points)
+
+                    # Label k of the crop is cell k-1 of its details, the kept cells are
+                    # numbered on from the cells of the windows before this one
+                    num_kept = sum(len(cells['points']) for cells in kept[channel])
+                    lookup = np.zeros(max(int(crop_labels[channel].max(initial=0)), len(points)) + 1, dtype=np.int32)
+                    lookup[np.flatnonzero(inside) + 1] = np.arange(num_kept + 1, num_kept + inside.sum() + 1)
+
+                    pasted = lookup[crop_labels[channel]]
+                    region = full_labels[channel][top:bottom, left:right]
+                    region[pasted > 0] = pasted[pasted > 0]
+
+                    kept[channel].append(dict(coord=np.asarray(details['coord'])[inside] + offset[:, np.newaxis],
+                                              points=points[inside],
+                                              prob=np.asarray(details['prob'])[inside]))
+
+        image_list = [compact_labels(labels) for labels in full_labels]
+        details_list = []
+        for cells in kept:
+            if len(cells) == 0:
+                # None of the regions are inside the image
+                cells = [dict(coord=np.zeros((0, 2, 0)), points=np.zeros((0, 2), dtype=int), prob=np.zeros(0))]
+            details_list.append({key: np.concatenate([window[key] for window in cells]) for key in cells[0]})
+
+        return image_list, details_list
+
+
+    def measure_cells(self, file_path, image_list, details_list, img=None):
+        '''Columns of the cell table of one image, see CellFeatures.cell_features. The
+        intensities are measured on the raw pixels, so they compare between images and
+        channels. img is the raw (H, W, C) image, it is read from file_path when not given'''
+
+        if img is None:
+            img = self.read_image(file_path)
+
+        with self.tracer.span("cell_features", image=os.path.basename(file_path)):
+            return cell_features(os.path.basename(file_path), img, image_list, details_list,
+                                 self.min_overlap, self.min_iou)
+
+
+    def colocalization_matrix(self, segmented_channels):
+        '''Colocalization counts between every pair of channels of an image, so any
+        channel can be picked as the electroporated one without recounting'''
+
+        return colocalization_matrix(segmented_channels, self.min_overlap, self.min_iou)
+
+
+    def count_colocalized_cells(self, electroporated: np.array, marker1: np.array, marker2: np.array):
+        '''Counts the electroporated cells that co-localize (overlap) with a marker1 cell,
+        and again with marker 2. Overlaps are matched by label, so touching cells are
+        still counted separately'''
+
+        with self.tracer.span("count_colocalized_cells"):
+            colocalize1, _ = colocalize(electroporated, marker1, self.min_overlap, self.min_iou)
+            colocalize2, _ = colocalize(electroporated, marker2, self.min_overlap, self.min_iou)
+
+        return colocalize1, colocalize2
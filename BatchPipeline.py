@@ -0,0 +1,300 @@
+import os
+import csv
+import json
+from glob import glob
+from itertools import islice
+import numpy as np
+from tifffile import imwrite
+from tqdm import tqdm
+from ResultsTable import COLOCALIZATION_COLUMNS
+from WorkQueue import default_worker_id
+from CellFeatures import feature_columns
+from FolderWatcher import FolderWatcher
+
+# The batch run modes of BatchSegment.py, each drives any backend built with
+# BaseModelInterface.create_model: a folder at once, a watched folder, or a share of
+# a WorkQueue. The app uses the same helpers for its own watch mode
+
+# Folder inside the output folder where queue workers save the result of every image
+QUEUE_RESULTS_FOLDER = "image_results"
+
+# Table with the measurements of every cell of every image in batch mode
+CELL_TABLE_NAME = "cells.csv"
+
+
+def segment_directory(model, directory, output_directory, electroporated_channel=3):
+    '''Segments every image in a directory without the GUI. The labels of each
+    channel are saved as one tif per image in the output directory, along with
+    a csv table of the colocalization ratios for every image and a csv table of
+    the measurements of every cell'''
+
+    file_list = sorted(glob(os.path.join(directory, '*.tif')))
+    if len(file_list) == 0:
+        raise FileNotFoundError(f"No images found in {directory}")
+
+    images = model.start_image_stream(file_list)
+    if model.n_channel != 3:
+        raise ValueError("Batch mode currently only supports 3 channel images")
+
+    os.makedirs(output_directory, exist_ok=True)
+    electroporated_idx = electroporated_channel - 1
+
+    rows = []
+    # The cells of each image are written as soon as it is segmented, a folder
+    # of dense sections has too many cells to keep in memory
+    with open(os.path.join(output_directory, CELL_TABLE_NAME), 'w', newline='') as f:
+        cell_writer = csv.writer(f)
+        cell_writer.writerow(feature_columns(model.n_channel))
+
+        for file_path, img, image_list, details_list, matrix in model.segment_stream(tqdm(images, total=len(file_list))):
+            # Save the labels of every channel as a single (C, H, W) image
+            labels = np.stack(image_list)
+            image_name = os.path.splitext(os.path.basename(file_path))[0]
+            imwrite(os.path.join(output_directory, f"{image_name}_labels.tif"), labels)
+
+            rows.append(colocalization_row(file_path, matrix, cell_counts(details_list), electroporated_idx))
+            cells = model.measure_cells(file_path, image_list, details_list)
+            cell_writer.writerows(zip(*cells.values()))
+
+    write_colocalization_table(output_directory, rows)
+    return rows
+
+
+def watch_directory(model, directory, output_directory, electroporated_channel=3, settle_seconds=2.0,
+                    poll_seconds=1.0, idle_timeout=None, stop_event=None):
+    '''Watch mode. Segments every image written into a directory as soon as it is
+    complete, and appends its row to colocalization.csv and its cells to cells.csv
+    in the output directory straight away. Images that are already in the table of
+    an earlier run are skipped. Runs until stop_event is set, no image arrives for
+    idle_timeout seconds or it is interrupted. Returns the number of images segmented'''
+
+    os.makedirs(output_directory, exist_ok=True)
+    electroporated_idx = electroporated_channel - 1
+
+    results = IncrementalResults(output_directory)
+    watcher = FolderWatcher(directory, settle_seconds, poll_seconds,
+                            skip=[os.path.join(directory, name) for name in results.done])
+    print(f"Watching {directory} for new images")
+
+    num_segmented = 0
+    try:
+        for file_path in watcher.watch(stop_event, idle_timeout):
+            try:
+                row, cells, _ = segment_watched_image(model, file_path, output_directory, electroporated_idx)
+            except Exception as e:
+                # A bad file should not end the session
+                print(f"Failed to segment {file_path}: {e}")
+                continue
+
+            results.add(row, cells)
+            num_segmented += 1
+            print(f"{os.path.basename(file_path)}: {row[3]} electroporated cells, ratios {row[1]} and {row[2]}")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        results.close()
+
+    print(f"Segmented {num_segmented} images, results are in {output_directory}")
+    return num_segmented
+
+
+def segment_watched_image(model, file_path, output_directory, electroporated_idx=2):
+    '''Segments one image of watch mode and saves its labels. Returns its row of the
+    colocalization table, its cell table and the segmentation result'''
+
+    img = model.prepare_image(file_path)
+    model.n_channel = 1 if img.ndim == 2 else img.shape[-1]
+    if model.n_channel != 3:
+        raise ValueError("Watch mode currently only supports 3 channel images")
+
+    # One image at a time, a batch would wait for images that were not taken yet
+    result = next(model.segment_stream([(file_path, img)]))
+    _, _, image_list, details_list, matrix = result
+
+    image_name = os.path.splitext(os.path.basename(file_path))[0]
+    imwrite(os.path.join(output_directory, f"{image_name}_labels.tif"), np.stack(image_list))
+
+    row = colocalization_row(file_path, matrix, cell_counts(details_list), electroporated_idx)
+    cells = model.measure_cells(file_path, image_list, details_list)
+    return row, cells, result
+
+
+def segment_queue(model, work_queue, output_directory, worker_id=None):
+    '''Distributed batch mode. Claims images from a WorkQueue shared with other
+    workers until none are left. The labels and a small json result of every image
+    are saved in the output folder, merge_queue_results builds the table from them.
+    Returns the number of images this worker segmented'''
+
+    worker_id = worker_id or default_worker_id()
+    os.makedirs(os.path.join(output_directory, QUEUE_RESULTS_FOLDER), exist_ok=True)
+
+    num_segmented = 0
+    while True:
+        file_path = work_queue.claim(worker_id)
+        if file_path is None:
+            break
+
+        try:
+            with work_queue.keep_alive(worker_id, file_path):
+                save_queue_result(model, file_path, output_directory)
+        except Exception as e:
+            print(f"Failed to segment {file_path}: {e}")
+            work_queue.fail(worker_id, file_path, e)
+            continue
+
+        work_queue.complete(worker_id, file_path)
+        num_segmented += 1
+
+    print(f"Worker {worker_id} segmented {num_segmented} images")
+    return num_segmented
+
+
+def save_queue_result(model, file_path, output_directory):
+    '''Segments one claimed image and saves its labels and results. Files are written
+    under a temporary name first, in case the claim went stale and another worker is
+    writing the same image'''
+
+    img = model.prepare_image(file_path)
+    model.n_channel = 1 if img.ndim == 2 else img.shape[-1]
+    if model.n_channel != 3:
+        raise ValueError("Batch mode currently only supports 3 channel images")
+
+    _, _, image_list, details_list, matrix = next(model.segment_stream([(file_path, img)]))
+    cells = model.measure_cells(file_path, image_list, details_list)
+
+    image_name = os.path.splitext(os.path.basename(file_path))[0]
+    temp_suffix = f".{os.getpid()}.tmp"
+
+    labels_path = os.path.join(output_directory, f"{image_name}_labels.tif")
+    imwrite(labels_path + temp_suffix, np.stack(image_list))
+    os.replace(labels_path + temp_suffix, labels_path)
+
+    result_path = os.path.join(output_directory, QUEUE_RESULTS_FOLDER, f"{image_name}.json")
+    with open(result_path + temp_suffix, 'w') as f:
+        json.dump(dict(file_name=os.path.basename(file_path),
+                       num_cells=cell_counts(details_list),
+                       colocalization_matrix=np.asarray(matrix).tolist()), f)
+    os.replace(result_path + temp_suffix, result_path)
+
+    cells_path = os.path.join(output_directory, QUEUE_RESULTS_FOLDER, f"{image_name}_cells.csv")
+    with open(cells_path + temp_suffix, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(cells.keys())
+        writer.writerows(zip(*cells.values()))
+    os.replace(cells_path + temp_suffix, cells_path)
+
+
+def cell_counts(details_list):
+    '''Number of cells found in every channel'''
+
+    # points has shape (n_cells, 2), so count the rows rather than the size
+    return [len(details['points']) for details in details_list]
+
+
+def write_colocalization_table(output_directory, rows):
+    '''Saves the colocalization ratios of every image as a csv table'''
+
+    table_path = os.path.join(output_directory, "colocalization.csv")
+    with open(table_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(COLOCALIZATION_COLUMNS)
+        writer.writerows(rows)
+
+    print(f"Saved results to {output_directory}")
+
+
+class IncrementalResults:
+    '''colocalization.csv and cells.csv of watch mode. The rows of every image are
+    appended and flushed as soon as it is segmented, so the tables can be opened
+    while the session goes on. The images already in colocalization.csv from an
+    earlier run are in done'''
+
+    def __init__(self, output_directory, num_channels=3):
+        table_path = os.path.join(output_directory, "colocalization.csv")
+
+        self.done = set()
+        if os.path.exists(table_path):
+            with open(table_path, newline='') as f:
+                self.done = {row[0] for row in islice(csv.reader(f), 1, None) if row}
+
+        self.table_file = open(table_path, 'a', newline='')
+        self.cell_file = open(os.path.join(output_directory, CELL_TABLE_NAME), 'a', newline='')
+        self.table_writer = csv.writer(self.table_file)
+        self.cell_writer = csv.writer(self.cell_file)
+
+        # Files opened for appending start at their end, so empty files need a header
+        if self.table_file.tell() == 0:
+            self.table_writer.writerow(COLOCALIZATION_COLUMNS)
+        if self.cell_file.tell() == 0:
+            self.cell_writer.writerow(feature_columns(num_channels))
+
+
+    def add(self, row, cells):
+        self.table_writer.writerow(row)
+        self.cell_writer.writerows(zip(*cells.values()))
+        self.table_file.flush()
+        self.cell_file.flush()
+
+
+    def close(self):
+        self.table_file.close()
+        self.cell_file.close()
+
+
+def colocalization_row(file_path, matrix, num_cells, electroporated_idx):
+    '''Row of the colocalization table for one image'''
+
+    coloc1, coloc2, num_electroporated = colocalization_ratios(matrix, num_cells, electroporated_idx)
+    return [os.path.basename(file_path), np.round(coloc1, 2), np.round(coloc2, 2), num_electroporated]
+
+
+def colocalization_ratios(matrix, num_cells, electroporated_idx):
+    '''Returns the ratio of electroporated cells that colocalize with marker 1 and
+    marker 2, along with the number of cells in the electroporated channel, looked up
+    from the colocalization matrix and the number of cells of every channel. Marker 1
+    is the lowest channel that is not the electroporated channel'''
+
+    marker1_idx, marker2_idx = [c for c in range(len(matrix)) if c != electroporated_idx]
+
+    num_electroporated = num_cells[electroporated_idx]
+    if num_electroporated == 0:
+        return 0.0, 0.0, 0
+
+    colocalize1 = matrix[electroporated_idx, marker1_idx]
+    colocalize2 = matrix[electroporated_idx, marker2_idx]
+
+    return colocalize1 / num_electroporated, colocalize2 / num_electroporated, num_electroporated
+
+
+def merge_queue_results(work_queue, output_directory, electroporated_channel=3):
+    '''Builds the colocalization table from the results the queue workers saved, for
+    every image that is done. Images that are still pending, claimed or failed are
+    listed and left out'''
+
+    electroporated_idx = electroporated_channel - 1
+
+    rows = []
+    with open(os.path.join(output_directory, CELL_TABLE_NAME), 'w', newline='') as cell_file:
+        for file_path in work_queue.files('done'):
+            image_name = os.path.splitext(os.path.basename(file_path))[0]
+            with open(os.path.join(output_directory, QUEUE_RESULTS_FOLDER, f"{image_name}.json")) as f:
+                result = json.load(f)
+
+            matrix = np.asarray(result['colocalization_matrix'])
+            rows.append(colocalization_row(result['file_name'], matrix, result['num_cells'], electroporated_idx))
+
+            # The cell tables of the images are joined, keeping the header of the first only
+            with open(os.path.join(output_directory, QUEUE_RESULTS_FOLDER, f"{image_name}_cells.csv"), newline='') as f:
+                header = f.readline()
+                if cell_file.tell() == 0:
+                    cell_file.write(header)
+                cell_file.writelines(f)
+
+    for status in ('pending', 'claimed', 'failed'):
+        unfinished = work_queue.files(status)
+        if unfinished:
+            print(f"{len(unfinished)} images are {status} and are not in the table: "
+                  f"{', '.join(os.path.basename(path) for path in unfinished)}")
+
+    write_colocalization_table(output_directory, rows)
+    return rows
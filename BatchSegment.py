@@ -0,0 +1,166 @@
+import os
+import argparse
+from glob import glob
+from BaseModelInterface import MODEL_BACKENDS, create_model
+from BatchPipeline import segment_directory, watch_directory, segment_queue, merge_queue_results
+from WorkQueue import WorkQueue
+from RegionOfInterest import load_roi_file, parse_rectangle
+
+
+def build_parser():
+    '''Command line options for segmenting a folder without the GUI'''
+
+    parser = argparse.ArgumentParser(description="Segment every tif in a folder without opening the image viewer")
+    parser.add_argument("model", help="Folder in which your model files are contained (ignored by backends without model files)")
+    parser.add_argument("images", help="Folder where your images are located")
+    parser.add_argument("output", help="Folder to save the label images and colocalization table to")
+    parser.add_argument("--backend", default="stardist", choices=list(MODEL_BACKENDS),
+                        help="Segmentation backend, classical is a fast watershed for previewing a folder")
+    parser.add_argument("--electroporated-channel", type=int, default=3, choices=[1, 2, 3],
+                        help="Channel (starting at 1) that holds the electroporated cells")
+    parser.add_argument("--lookahead", type=int, default=2,
+                        help="Number of images that are read and normalized ahead of the one being segmented")
+    parser.add_argument("--prefetch-workers", type=int, default=1,
+                        help="Threads reading and normalizing images in the background (0 to read inline)")
+    parser.add_argument("--normalize-subsample", type=int, default=1,
+                        help="Only use every n-th row and column to find the normalization percentiles")
+    parser.add_argument("--batch-size", type=int, default=1,
+                        help="Number of channels passed through the network at once (1 segments each channel with tiling)")
+    parser.add_argument("--postprocess-workers", type=int, default=0,
+                        help="Processes running the non-maximum suppression after the network (0 runs it in this process)")
+    parser.add_argument("--tile-memory-mb", type=float, default=None,
+                        help="Estimated memory limit for one tile of the network (default uses StarDist's guess)")
+    parser.add_argument("--autotune-tiles", action="store_true",
+                        help="Time a few tilings on the first image and keep the fastest")
+    parser.add_argument("--tflite-model", default=None,
+                        help="Run the network from a TensorFlow Lite file made with QuantizeModel.py instead of Keras")
+    parser.add_argument("--intra-op-threads", type=int, default=None,
+                        help="Threads used inside one network operation (also the TFLite interpreter's threads)")
+    parser.add_argument("--inter-op-threads", type=int, default=None,
+                        help="Network operations TensorFlow runs at the same time")
+    parser.add_argument("--min-overlap", type=int, default=1,
+                        help="Pixels an electroporated and a marker cell need to overlap to colocalize")
+    parser.add_argument("--min-iou", type=float, default=0.0,
+                        help="Intersection over union an electroporated and a marker cell need to colocalize")
+    parser.add_argument("--cache-dir", default=None,
+                        help="Folder to cache results in, so unchanged images are not segmented again")
+    parser.add_argument("--cache-size-mb", type=float, default=2048,
+                        help="Size the results cache is kept under, the least recently used results are removed first")
+    parser.add_argument("--trace", default=None,
+                        help="JSON lines file to write the time and memory of every stage to")
+    parser.add_argument("--roi", action="append", default=[],
+                        help="Only segment the rectangle left,top,right,bottom (in pixels) of every image, can be given more than once")
+    parser.add_argument("--roi-file", default=None,
+                        help="json file of rectangle and polygon regions by image file name, see the README")
+    parser.add_argument("--roi-padding", type=int, default=None,
+                        help="Pixels around each region that are segmented too, so cells on its edge are whole "
+                             "(default is enough for the model)")
+    parser.add_argument("--queue", default=None,
+                        help="SQLite file of a work queue shared by several workers, each worker started with the "
+                             "same queue segments the images it claims and saves its results in the output folder")
+    parser.add_argument("--merge", action="store_true",
+                        help="With --queue, build the colocalization table from the results of the workers")
+    parser.add_argument("--worker-id", default=None,
+                        help="Name of this worker in the queue (default is the host name and process id)")
+    parser.add_argument("--stale-after", type=float, default=600,
+                        help="Seconds without a heartbeat after which the image a worker claimed is given to another worker")
+    parser.add_argument("--watch", action="store_true",
+                        help="Keep watching the images folder and segment every tif as soon as it is fully written, "
+                             "appending its results to the tables in the output folder")
+    parser.add_argument("--settle-seconds", type=float, default=2.0,
+                        help="With --watch, seconds a file has to stay unchanged before it is segmented")
+    parser.add_argument("--poll-seconds", type=float, default=1.0,
+                        help="With --watch, how often the folder is checked for new images")
+    parser.add_argument("--idle-timeout", type=float, default=None,
+                        help="With --watch, stop after this many seconds without a new image (default runs until Ctrl+C)")
+    parser.add_argument("--large-images", action="store_true",
+                        help="Memory map the images and segment them block by block, for images too large to fit in memory")
+    parser.add_argument("--block-size", type=int, default=4096,
+                        help="Size in pixels of the blocks large images are segmented in")
+    parser.add_argument("--block-overlap", type=int, default=128,
+                        help="Overlap in pixels between blocks of large images, has to be larger than any cell")
+
+    return parser
+
+
+def backend_options(parser, args):
+    '''Keyword arguments of the options only some backends take. An option the
+    chosen backend does not take is an error when it was changed from its default,
+    instead of being silently dropped'''
+
+    supported = MODEL_BACKENDS[args.backend]['options']
+    options = {}
+    for name in ("batch_size", "postprocess_workers", "tile_memory_mb", "autotune_tiles",
+                 "tflite_model", "intra_op_threads", "inter_op_threads"):
+        value = getattr(args, name)
+        if name in supported:
+            options[name] = value
+        elif value != parser.get_default(name):
+            parser.error(f"--{name.replace('_', '-')} is not supported by the {args.backend} backend")
+    return options
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    options = backend_options(parser, args)
+    if args.watch and (args.queue is not None or args.large_images):
+        raise SystemExit("--watch can not be combined with --queue or --large-images")
+    if args.tflite_model is not None and args.large_images:
+        raise SystemExit("--tflite-model can not be used with --large-images, large images are segmented with Keras")
+    if args.tflite_model is not None and (args.tile_memory_mb is not None or args.autotune_tiles):
+        raise SystemExit("--tile-memory-mb and --autotune-tiles can not be used with --tflite-model, "
+                         "the TFLite network runs on the whole image without tiling")
+
+    work_queue = None
+    if args.queue is not None:
+        work_queue = WorkQueue(args.queue, stale_after=args.stale_after)
+
+        # The merge only reads the saved results, so no model is loaded
+        if args.merge:
+            merge_queue_results(work_queue, args.output, args.electroporated_channel)
+            return
+
+        # Every worker adds the folder, images already in the queue are skipped
+        file_list = sorted(glob(os.path.join(args.images, '*.tif')))
+        if len(file_list) == 0:
+            raise FileNotFoundError(f"No images found in {args.images}")
+        work_queue.add_files(file_list)
+
+    options.update(lookahead=args.lookahead,
+                   prefetch_workers=args.prefetch_workers,
+                   normalize_subsample=args.normalize_subsample,
+                   min_overlap=args.min_overlap,
+                   min_iou=args.min_iou,
+                   cache_directory=args.cache_dir,
+                   cache_size_mb=args.cache_size_mb,
+                   trace_path=args.trace)
+
+    model = create_model(args.backend, args.model, **options)
+    if args.large_images and not model.capabilities()['large_images']:
+        raise SystemExit(f"The {args.backend} backend can not segment large images")
+
+    if args.roi_file is not None:
+        model.rois = load_roi_file(args.roi_file)
+    if args.roi:
+        model.rois["*"] = [parse_rectangle(text) for text in args.roi]
+    if args.roi_padding is not None:
+        model.roi_padding = args.roi_padding
+
+    try:
+        if work_queue is not None:
+            segment_queue(model, work_queue, args.output, args.worker_id)
+        elif args.watch:
+            watch_directory(model, args.images, args.output, args.electroporated_channel,
+                            args.settle_seconds, args.poll_seconds, args.idle_timeout)
+        elif args.large_images:
+            model.segment_large_directory(args.images, args.output, args.electroporated_channel,
+                                          args.block_size, args.block_overlap)
+        else:
+            segment_directory(model, args.images, args.output, args.electroporated_channel)
+    finally:
+        model.close()
+
+
+if __name__ == "__main__":
+    main()
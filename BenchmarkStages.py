@@ -0,0 +1,245 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+from scipy import ndimage as ndi
+from tifffile import imread, imwrite
+from Rendering import label_lut, composite_layers, render_cache
+from ClassicalSegmentation import ClassicalWatershed
+
+# Times and memory profiles every stage of the pipeline separately on synthetic nuclei
+# images, so hardware can be sized and changes to tiling or batching can be checked
+# against a stored baseline. The network and NMS stages only run when --model is given
+
+
+def parse_args(argv=None):
+    '''Command line options for the benchmark'''
+
+    parser = argparse.ArgumentParser(description="Benchmark each stage of the segmentation pipeline on synthetic images")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[512, 1024, 2048],
+                        help="Side length in pixels of the square synthetic images")
+    parser.add_argument("--densities", type=float, nargs="+", default=[200, 1000],
+                        help="Number of nuclei per channel in every 1000 x 1000 pixels")
+    parser.add_argument("--channels", type=int, default=3,
+                        help="Number of channels of the synthetic images, at least 3")
+    parser.add_argument("--radius", type=float, default=6,
+                        help="Radius in pixels of the synthetic nuclei")
+    parser.add_argument("--repeats", type=int, default=3,
+                        help="Number of times each stage is timed, the median is reported")
+    parser.add_argument("--model", default=None,
+                        help="StarDist model folder, adds the network prediction and NMS stages")
+    parser.add_argument("--batch-size", type=int, default=1,
+                        help="Batch size of the model, as in BatchSegment.py. Above 1 the network is also timed on a batch of this many channels")
+    parser.add_argument("--tile-memory-mb", type=float, default=None,
+                        help="Tile memory limit of the model, as in BatchSegment.py")
+    parser.add_argument("--tflite-model", default=None,
+                        help="TensorFlow Lite network of the model made with QuantizeModel.py, as in BatchSegment.py")
+    parser.add_argument("--intra-op-threads", type=int, default=None,
+                        help="Threads used inside one network operation, as in BatchSegment.py")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark_results.json",
+                        help="File to write the results to as json")
+    parser.add_argument("--baseline", default=None,
+                        help="Results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Fraction a stage can be slower than the baseline before it counts as a regression")
+
+    args = parser.parse_args(argv)
+    if args.tflite_model is not None and args.tile_memory_mb is not None:
+        parser.error("--tile-memory-mb can not be used with --tflite-model, the TFLite network runs without tiling")
+    return args
+
+
+def synthetic_image(size, density, num_channels=3, radius=6, seed=0):
+    '''Returns a (C, H, W) uint16 image of blurred round nuclei on a noisy background,
+    laid out like the microscope images, and the (H, W) label image of every channel.
+    The channels share part of their nuclei so there is something to colocalize'''
+
+    rng = np.random.default_rng(seed)
+    num_cells = max(1, int(round(density * size * size / 1e6)))
+
+    # Half of each channel's nuclei come from a pool every channel draws from
+    shared = rng.uniform(radius, size - radius, size=(num_cells, 2))
+
+    channels = []
+    label_list = []
+    for _ in range(num_channels):
+        own = rng.uniform(radius, size - radius, size=(num_cells - num_cells // 2, 2))
+        picked = shared[rng.choice(num_cells, num_cells // 2, replace=False)]
+        centers = np.concatenate([picked, own]).astype(np.int64)
+
+        seeds = np.zeros((size, size), dtype=np.int32)
+        seeds[centers[:, 0], centers[:, 1]] = np.arange(1, len(centers) + 1)
+
+        # Every pixel within radius of a center belongs to the nearest center
+        distance, (rows, cols) = ndi.distance_transform_edt(seeds == 0, return_indices=True)
+        labels = np.where(distance <= radius, seeds[rows, cols], 0)
+
+        signal = ndi.gaussian_filter((labels > 0).astype(np.float32), 1.5) * 3000
+        noise = rng.normal(200, 30, size=(size, size))
+        channels.append(np.clip(signal + noise, 0, 65535).astype(np.uint16))
+        label_list.append(labels)
+
+    return np.stack(channels), label_list
+
+
+def measure(stage, repeats):
+    '''Runs stage() repeats times. Returns the median and fastest time in seconds, the
+    peak memory numpy and python allocated during one run in MB, and the last result'''
+
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = stage()
+        times.append(time.perf_counter() - start)
+
+    # Measured on a separate run, tracemalloc slows down python allocations
+    tracemalloc.start()
+    stage()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return dict(median_s=float(np.median(times)), min_s=float(np.min(times)), peak_mb=peak / 1024 ** 2), result
+
+
+def benchmark_image(args, size, density, model, network):
+    '''Benchmarks every stage on one synthetic image, returns a list of result rows'''
+
+    img, true_labels = synthetic_image(size, density, args.channels, args.radius, args.seed)
+    rows = []
+
+    def record(stage, function):
+        stats, result = measure(function, args.repeats)
+        rows.append(dict(stage=stage, size=size, density=density, **stats))
+        print(f"{stage:>24} {size:>6} px {density:>7g} cells/Mpx {stats['median_s'] * 1000:10.2f} ms {stats['peak_mb']:9.1f} MB")
+        return result
+
+    with tempfile.TemporaryDirectory() as directory:
+        file_path = os.path.join(directory, "synthetic.tif")
+        imwrite(file_path, img)
+        loaded = record("tiff_load", lambda: imread(file_path))
+
+    adjusted = record("adjust_image_channels", lambda: np.ascontiguousarray(model.adjust_image_channels(loaded)))
+    normalized = record("normalize_image", lambda: model.normalize_image(adjusted))
+
+    if network is not None:
+        # One channel, the same call segment_channels makes
+        x = network.model_input(normalized, 0)
+        if network.tflite_network is None:
+            n_tiles = network.get_n_tiles(x)
+            prob, dist, points = record("network_prediction",
+                                        lambda: network.StarDistModel.predict_sparse(x, n_tiles=n_tiles, show_tile_progress=False))
+        else:
+            from PostProcessing import sparse_prediction
+            dense = record("network_prediction", lambda: network.predict_batch(x[np.newaxis]))
+            prob, dist, points = sparse_prediction(normalized.shape[:2], dense[0][0], dense[1][0],
+                                                   network.StarDistModel.config.grid, network.StarDistModel.thresholds.prob)
+
+        if network.batch_size > 1:
+            # batch_size single channel inputs in one forward pass, as segment_batch runs
+            # them. Images that need tiling are not batched, so neither are they here
+            if network.tflite_network is None and np.prod(network.get_n_tiles(x)) > 1:
+                print(f"{'network_prediction_batch':>24} {size:>6} px skipped, images of this size are tiled and not batched")
+            else:
+                batch = np.stack([network.model_input(normalized, c % normalized.shape[-1]) for c in range(network.batch_size)])
+                record("network_prediction_batch", lambda: network.predict_batch(batch))
+                rows[-1]['batch_size'] = network.batch_size
+
+        from PostProcessing import instances_from_prediction
+        nms_thresh = network.StarDistModel.thresholds.nms
+        record("nms", lambda: instances_from_prediction(normalized.shape[:2], prob, dist, points, nms_thresh))
+
+    # The ground truth labels stand in for the model output from here on
+    record("count_colocalized_cells", lambda: model.count_colocalized_cells(*true_labels[:3]))
+
+    # Details with a row for every ground truth cell, like the network returns them
+    details = [dict(points=np.zeros((int(labels.max()), 2), dtype=np.int32),
+                    prob=np.ones(int(labels.max()), dtype=np.float32)) for labels in true_labels[:3]]
+    record("cell_features", lambda: model.measure_cells("synthetic.tif", true_labels[:3], details, adjusted[:, :, :3]))
+
+    # What the viewer does once per image and then for every redraw. Its canvas is half
+    # the size of the image, and it shows three channels as the three color planes
+    display_size = (max(1, size // 2), max(1, size // 2))
+    gray_layers, display_labels, outlines = record("viewer_render_cache",
+                                                   lambda: render_cache(normalized[:, :, :3], true_labels[:3], *display_size))
+    max_label = max(int(labels.max()) for labels in true_labels[:3])
+    luts = [label_lut(0.5, max_label) for _ in range(3)]
+    record("viewer_compositing", lambda: composite_layers(gray_layers, display_labels, [True] * 3, luts))
+    record("viewer_outline_compositing", lambda: composite_layers(gray_layers, display_labels, [True] * 3, luts, outlines))
+
+    return rows
+
+
+def compare(results, baseline, tolerance):
+    '''Prints the change of every stage against the baseline, returns the stages
+    that got slower by more than the tolerance'''
+
+    previous = {(row['stage'], row['size'], row['density']): row for row in baseline['results']}
+
+    regressions = []
+    print("\nCompared to the baseline:")
+    for row in results['results']:
+        key = (row['stage'], row['size'], row['density'])
+        if key not in previous:
+            continue
+
+        change = row['median_s'] / previous[key]['median_s'] - 1
+        flag = ""
+        if change > tolerance:
+            regressions.append(key)
+            flag = "  REGRESSION"
+        print(f"{row['stage']:>24} {row['size']:>6} px {row['density']:>7g} cells/Mpx {change * 100:+8.1f} %{flag}")
+
+    return regressions
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    # The preprocessing and colocalization stages only need a BaseModel, not a network
+    model = ClassicalWatershed(prefetch_workers=0)
+
+    network = None
+    if args.model is not None:
+        from BaseModelInterface import create_model
+        network = create_model("stardist", args.model, prefetch_workers=0,
+                               batch_size=args.batch_size, tile_memory_mb=args.tile_memory_mb,
+                               tflite_model=args.tflite_model, intra_op_threads=args.intra_op_threads)
+        network.warm_up()
+
+    rows = []
+    for size in args.sizes:
+        for density in args.densities:
+            rows.extend(benchmark_image(args, size, density, model, network))
+
+    results = dict(environment=dict(python=platform.python_version(),
+                                    numpy=np.__version__,
+                                    machine=platform.machine(),
+                                    processor=platform.processor(),
+                                    cpu_count=os.cpu_count(),
+                                    model=args.model,
+                                    batch_size=args.batch_size,
+                                    tile_memory_mb=args.tile_memory_mb,
+                                    tflite_model=args.tflite_model,
+                                    intra_op_threads=args.intra_op_threads,
+                                    repeats=args.repeats),
+                   results=rows)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Saved results to {args.output}")
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+import numpy as np
+from Colocalization import label_overlap, match_overlaps
+from ResultsTable import CELL_COLUMNS
+
+# Measurements of every cell, computed with one bincount per quantity over the whole
+# label image instead of a loop over the cells, since dense sections have tens of
+# thousands of nuclei. Like Colocalization.py only numpy is needed
+
+
+def feature_columns(num_channels):
+    '''Columns of the cell table for images with num_channels channels. The intensity
+    of every cell is measured in every channel, and its partner is the cell it
+    overlaps the most in each channel (0 when it does not colocalize with any)'''
+
+    columns = CELL_COLUMNS + ["Area", "Centroid Y", "Centroid X"]
+    for channel in range(1, num_channels + 1):
+        columns += [f"Mean Intensity {channel}", f"Integrated Intensity {channel}"]
+    for channel in range(1, num_channels + 1):
+        columns += [f"Partner {channel}", f"Partner IoU {channel}"]
+    return columns
+
+
+def cell_features(image_name, img, label_images, details_list, min_overlap=1, min_iou=0.0):
+    '''Columns of the cell table for every cell in every channel of one image. Cell k
+    is label k in the label image of its channel and row k - 1 of its details. img is
+    the (H, W, C) image the labels were segmented from, in the pipeline these are the
+    raw pixels before normalization, so intensities compare between images'''
+
+    num_channels = len(label_images)
+    num_cells = [len(np.asarray(details['prob'])) for details in details_list]
+    partners = best_partners(label_images, num_cells, min_overlap, min_iou)
+
+    height, width = label_images[0].shape
+    rows = np.repeat(np.arange(height, dtype=np.float64), width)
+    cols = np.tile(np.arange(width, dtype=np.float64), height)
+    intensities = [np.asarray(img[:, :, channel], dtype=np.float64).ravel() for channel in range(num_channels)]
+
+    columns = {name: [] for name in feature_columns(num_channels)}
+    for channel, (labels, details) in enumerate(zip(label_images, details_list)):
+        n = num_cells[channel]
+        labels = labels.ravel()
+
+        # Index 0 is the background, cell k is at index k
+        area = label_sums(labels, n)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            # Cells that were painted over by their neighbours have no pixels left, and no centroid
+            centroid_y = label_sums(labels, n, rows) / area
+            centroid_x = label_sums(labels, n, cols) / area
+
+        points = np.asarray(details['points']).reshape(-1, 2)
+        columns["File Name"].extend([image_name] * n)
+        columns["Channel"].extend([channel + 1] * n)
+        columns["Cell"].extend(range(1, n + 1))
+        columns["Y"].extend(points[:, 0].tolist())
+        columns["X"].extend(points[:, 1].tolist())
+        columns["Probability"].extend(np.round(np.asarray(details['prob'], dtype=float), 4).tolist())
+        columns["Area"].extend(area.astype(np.int64).tolist())
+        columns["Centroid Y"].extend(np.round(centroid_y, 2).tolist())
+        columns["Centroid X"].extend(np.round(centroid_x, 2).tolist())
+
+        for other in range(num_channels):
+            integrated = label_sums(labels, n, intensities[other])
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean = integrated / area
+            columns[f"Mean Intensity {other + 1}"].extend(np.round(mean, 4).tolist())
+            columns[f"Integrated Intensity {other + 1}"].extend(np.round(integrated, 4).tolist())
+
+            partner, iou = partners[channel, other]
+            columns[f"Partner {other + 1}"].extend(partner.tolist())
+            columns[f"Partner IoU {other + 1}"].extend(np.round(iou, 4).tolist())
+
+    return columns
+
+
+def label_sums(labels, num_cells, weights=None):
+    '''Sum of weights (or the number of pixels) of cells 1 to num_cells of a flat label image'''
+
+    sums = np.bincount(labels, weights=weights, minlength=num_cells + 1)
+    return sums[1:num_cells + 1].astype(np.float64)
+
+
+def best_partners(label_images, num_cells, min_overlap=1, min_iou=0.0):
+    '''For every pair of channels, the cell of the second channel that each cell of the
+    first overlaps the most out of the pairs that colocalize, and the IoU of the two.
+    Returns a dictionary of (channel, other channel) -> (partner labels, IoU). Each
+    pair of channels is only overlapped once, a cell is its own partner'''
+
+    partners = {}
+    areas = [np.bincount(labels.ravel()) for labels in label_images]
+
+    for i, labels_i in enumerate(label_images):
+        partners[i, i] = np.arange(1, num_cells[i] + 1), np.ones(num_cells[i])
+
+        for j in range(i + 1, len(label_images)):
+            a, b, overlap = label_overlap(labels_i, label_images[j])
+            _, matches = match_overlaps(a, b, overlap, areas[i], areas[j], min_overlap, min_iou)
+
+            partners[i, j] = largest_overlap(matches['electroporated'], matches['marker'],
+                                             matches['overlap'], matches['iou'], num_cells[i])
+            partners[j, i] = largest_overlap(matches['marker'], matches['electroporated'],
+                                             matches['overlap'], matches['iou'], num_cells[j])
+
+    return partners
+
+
+def largest_overlap(ids, other_ids, overlap, iou, num_cells):
+    '''Picks the pair with the largest overlap for every cell in ids'''
+
+    partner = np.zeros(num_cells, dtype=np.int64)
+    partner_iou = np.zeros(num_cells)
+    if len(ids) == 0:
+        return partner, partner_iou
+
+    # Sorted by cell and then overlap, the last pair of each cell is its largest
+    order = np.lexsort((overlap, ids))
+    ids, other_ids, iou = ids[order], other_ids[order], iou[order]
+    last = np.append(ids[1:] != ids[:-1], True) & (ids <= num_cells)
+
+    partner[ids[last] - 1] = other_ids[last]
+    partner_iou[ids[last] - 1] = iou[last]
+    return partner, partner_iou
@@ -0,0 +1,114 @@
+import numpy as np
+
+# Colocalization of label images (0 is background). Only numpy is used so the
+# GUI and the batch tools can use these without loading the model
+
+
+def label_overlap(labels_a: np.ndarray, labels_b: np.ndarray):
+    '''Sparse contingency table of two label images in one vectorized pass. Returns
+    (a labels, b labels, overlap in pixels) for every pair of cells that overlap'''
+
+    overlap_mask = (labels_a > 0) & (labels_b > 0)
+    a = labels_a[overlap_mask].astype(np.int64)
+    b = labels_b[overlap_mask].astype(np.int64)
+
+    # Encode each (a, b) pair as a single id so the pairs can be counted at once
+    n_b = int(labels_b.max(initial=0)) + 1
+    pairs, overlap = np.unique(a * n_b + b, return_counts=True)
+
+    return pairs // n_b, pairs % n_b, overlap
+
+
+def colocalize(electroporated: np.ndarray, marker: np.ndarray, min_overlap=1, min_iou=0.0):
+    '''Matches the cells of the electroporated label image with the marker cells they 
+    overlap. A pair only counts when it overlaps by at least min_overlap pixels and has
+    an IoU of at least min_iou. Returns the number of electroporated cells with a match
+    and a dictionary of the matching pairs (electroporated, marker, overlap, iou)'''
+
+    electroporated_ids, marker_ids, overlap = label_overlap(electroporated, marker)
+
+    return match_overlaps(electroporated_ids, marker_ids, overlap,
+                          np.bincount(electroporated.ravel()), np.bincount(marker.ravel()),
+                          min_overlap, min_iou)
+
+
+def match_overlaps(electroporated_ids, marker_ids, overlap, electroporated_area, marker_area, min_overlap=1, min_iou=0.0):
+    '''Keeps the overlapping pairs that pass both thresholds, given the overlap table
+    and the area of every label. Returns the same as colocalize'''
+
+    iou = overlap / (electroporated_area[electroporated_ids] + marker_area[marker_ids] - overlap)
+
+    keep = (overlap >= min_overlap) & (iou >= min_iou)
+    matches = dict(electroporated=electroporated_ids[keep],
+                   marker=marker_ids[keep],
+                   overlap=overlap[keep],
+                   iou=iou[keep])
+
+    return len(np.unique(matches['electroporated'])), matches
+
+
+def colocalization_matrix(label_list: list[np.ndarray], min_overlap=1, min_iou=0.0):
+    '''Colocalization of every pair of channels. matrix[i, j] is the number of cells in
+    channel i that colocalize with a cell in channel j, and the diagonal holds the number
+    of cells in each channel. Each pair of channels is only overlapped once'''
+
+    num_channels = len(label_list)
+    matrix = np.zeros((num_channels, num_channels), dtype=np.int64)
+
+    for i in range(num_channels):
+        matrix[i, i] = np.count_nonzero(np.bincount(label_list[i].ravel())[1:])
+
+        for j in range(i + 1, num_channels):
+            _, matches = colocalize(label_list[i], label_list[j], min_overlap, min_iou)
+            # The matches are the same in both directions, only the cells counted differ
+            matrix[i, j] = len(np.unique(matches['electroporated']))
+            matrix[j, i] = len(np.unique(matches['marker']))
+
+    return matrix
+
+
+def colocalization_matrix_blocked(label_list, block_rows=2048, min_overlap=1, min_iou=0.0):
+    '''Same as colocalization_matrix for label images that do not fit in memory (such
+    as memory mapped files). The images are read in strips of block_rows rows and the
+    overlap tables and areas of the strips are added together'''
+
+    num_channels = len(label_list)
+    height = label_list[0].shape[0]
+
+    areas = [np.zeros(1, dtype=np.int64) for _ in range(num_channels)]
+    tables = {(i, j): [] for i in range(num_channels) for j in range(i + 1, num_channels)}
+
+    for start in range(0, height, block_rows):
+        strips = [np.asarray(labels[start:start + block_rows]) for labels in label_list]
+
+        for i in range(num_channels):
+            areas[i] = add_counts(areas[i], np.bincount(strips[i].ravel()))
+        for i, j in tables:
+            tables[(i, j)].append(label_overlap(strips[i], strips[j]))
+
+    matrix = np.zeros((num_channels, num_channels), dtype=np.int64)
+    for i in range(num_channels):
+        matrix[i, i] = np.count_nonzero(areas[i][1:])
+
+    for (i, j), parts in tables.items():
+        # A pair of cells that crosses a strip border shows up in both strips
+        a_ids, b_ids, overlap = (np.concatenate(part) for part in zip(*parts))
+        n_b = int(b_ids.max(initial=0)) + 1
+        pairs, inverse = np.unique(a_ids * n_b + b_ids, return_inverse=True)
+        overlap = np.bincount(inverse, weights=overlap).astype(np.int64)
+
+        _, matches = match_overlaps(pairs // n_b, pairs % n_b, overlap, areas[i], areas[j], min_overlap, min_iou)
+        matrix[i, j] = len(np.unique(matches['electroporated']))
+        matrix[j, i] = len(np.unique(matches['marker']))
+
+    return matrix
+
+
+def add_counts(a, b):
+    '''Adds two bincount results that can have different lengths'''
+
+    if len(a) < len(b):
+        a, b = b, a
+    a = a.copy()
+    a[:len(b)] += b
+    return a
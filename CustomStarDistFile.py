@@ -1,131 +1,500 @@
+import os
+import time
 from BaseModelInterface import BaseModel
-from tkinter import filedialog, messagebox, ttk
+from BatchPipeline import cell_counts, colocalization_row, write_colocalization_table
 import numpy as np
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
 from glob import glob
-from tifffile import imread
-from tqdm import tqdm
-from csbdeep.utils import normalize
+import tifffile
 from stardist.models import StarDist2D
-from stardist.models import StarDist2D
-import cv2
+from Colocalization import colocalization_matrix_blocked
+from LargeImage import open_large_image, ChannelView
+from ResultsCache import fingerprint_files
+from PostProcessing import instances_from_prediction, sparse_prediction, compact_labels
+from TFLiteInference import TFLiteNetwork, configure_threads
+
+# StarDist models already loaded in this process, keyed by the model folder, so
+# choosing the same model again does not read the weights and rebuild the network
+_model_registry = {}
+_model_registry_lock = threading.Lock()
+
+
+def load_stardist_model(model_name, base_directory):
+    '''Returns the StarDist2D model in base_directory/model_name, loading it the
+    first time it is asked for'''
+
+    key = os.path.abspath(os.path.join(base_directory, model_name))
+    with _model_registry_lock:
+        if key not in _model_registry:
+            _model_registry[key] = StarDist2D(None, name=model_name, basedir=base_directory)
+        return _model_registry[key]
 
 
 class CustomStarDist(BaseModel):
     # Constructor when the user passes through a pretrained models location in directory
-    def __init__(self, model_name, base_directory, root, GUI):
-        # Setting up the window 
-        self.root = root
+    def __init__(self, model_name, base_directory, lookahead=2, prefetch_workers=1, normalize_subsample=1,
+                 batch_size=1, postprocess_workers=0, tile_memory_mb=None, autotune_tiles=False,
+                 min_overlap=1, min_iou=0.0, cache_directory=None, cache_size_mb=2048, trace_path=None,
+                 tflite_model=None, intra_op_threads=None, inter_op_threads=None):
+        BaseModel.__init__(self, lookahead, prefetch_workers, normalize_subsample,
+                           batch_size, min_overlap, min_iou, trace_path)
+
+        # Thread pools of TensorFlow, they have to be set before the model is loaded
+        if intra_op_threads is not None or inter_op_threads is not None:
+            configure_threads(intra_op_threads, inter_op_threads)
+
         # Initialize the model
-        self.StarDistModel = StarDist2D(None, name=model_name, basedir=base_directory)
-
-        self.GUI = GUI
-
-        self.X = None
-
-        
-    def load_images(self,directory):
-        '''Loads images into a list of arrays to be passed through the model'''
-
-        print("Loading Images")
-        messagebox.showinfo("Loading Images")
-        # Read Images
-        try:
-            self.file_list = sorted(glob(f'{directory}/*.tif'))
-            self.X = list(map(imread, self.file_list))
-            if len(self.X) == 0:
-                messagebox.showinfo("No Images", "No images found in the specified directory.")
-                return
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to read images: {e}")
-            return
-    
-        if self.X[0].shape[0] == 3:
-            self.adjust_image_channels()
+        self.StarDistModel = load_stardist_model(model_name, base_directory)
+
+        # With an exported TensorFlow Lite network (see QuantizeModel.py) the network runs
+        # in the TFLite interpreter on intra_op_threads threads instead of in Keras. The
+        # whole image goes through it at once, it is not tiled
+        self.tflite_network = None
+        if tflite_model is not None:
+            self.tflite_network = TFLiteNetwork(tflite_model, self.StarDistModel.config.n_rays, intra_op_threads)
 
-        self.normalize_images()
-        
-        self.run_model()
+        # Number of processes running the non-maximum suppression and label
+        # rendering after the network, 0 runs them in this process
+        self.postprocess_workers = postprocess_workers
+        self.postprocess_pool = None
 
-    def adjust_image_channels(self):
-        '''Moves color channel last, from (C, W, H) to (W, H, C)'''
+        # Number of tiles to use for each (image shape, dtype, memory budget), so
+        # the tiling is only worked out once for a folder of same sized images.
+        # tile_memory_mb limits the estimated memory of one tile (None uses
+        # StarDist's guess) and autotune_tiles times a few choices on the first image
+        self.tile_plans = {}
+        self.tile_memory_mb = tile_memory_mb
+        self.autotune_tiles = autotune_tiles
 
-        for i in range(len(self.X)):
-            self.X[i] = np.moveaxis(self.X[i], 0, -1)
+        # Crops of regions of interest start where the network's downsampling lines up
+        # with the whole image, and are padded by at least the network's field of view,
+        # so a region gets the same cells as the full frame
+        self.roi_alignment = max(self.StarDistModel._axes_div_by('YX'))
+        self.roi_padding = max(self.roi_padding, *self.StarDistModel._axes_tile_overlap('YX'))
 
-    def normalize_images(self):
-        '''Normalizes the images before being passed throught the model'''
+        self.init_results_cache(cache_directory, cache_size_mb)
 
-        self.n_channel = 1 if self.X[0].ndim == 2 else self.X[0].shape[-1]
-        axis_norm = (0, 1)
-        if self.n_channel > 1:
-            print("Normalizing image channels %s." % ('jointly' if axis_norm is None or 2 in axis_norm else 'independently'))
-        self.X = [normalize(x, 1, 99.8, axis=axis_norm) for x in tqdm(self.X)]
 
+    def capabilities(self):
+        # Any number of channels can go through the network in one forward pass
+        # (batch_size of 1 segments every channel separately with tiling)
+        return dict(max_batch_size=None, tiling=True, large_images=True)
 
-    def run_model(self):
-        '''Calls segment_channels, then waits for user to 
-        move onto the next image in the viewer'''
 
-        # Create counter for analytics screen to keep track 
-        # of what row in the table we are on
-        self.img_count = 0
-        # Create the Analytics Screen
-        self.GUI.create_analytics_screen(self.file_list, self.n_channel, self)
-        for img in self.X:
-            # Index to be used by the GUI, image_count starts at 1
-            self.img_count +=1    
+    def warm_up(self):
+        '''Runs the network once on a small blank image, so the first real image
+        does not also pay for TensorFlow setting up the graph'''
 
-            self.segment_channels(img)
+        div_by = self.StarDistModel._axes_div_by('YXC')
+        shape = (4 * div_by[0], 4 * div_by[1])
+        if self.StarDistModel.config.n_channel_in > 1:
+            shape += (self.StarDistModel.config.n_channel_in,)
 
-            # Wait for the image viewer window to be closed before continuing
-            self.root.wait_window(self.GUI.current_viewer_window)
+        if self.tflite_network is not None:
+            self.predict_batch(np.zeros((1,) + shape, dtype=np.float32))
+            return
 
+        self.StarDistModel.predict(np.zeros(shape, dtype=np.float32))
 
 
     def segment_channels(self, img: np.ndarray):
-        '''Creates a list of three channel label images output from the model'''
+        '''Creates a list of label images output from the model, one integer 
+        label image per channel'''
+
+        # The TensorFlow Lite network is not tiled
+        if self.tflite_network is not None:
+            return self.segment_untiled(img)
+
+        image_list = []
+        details_list = []
+        num_channels = img.shape[-1]
+
+        # Every channel has the same shape, so they share one tile plan
+        n_tiles = self.get_n_tiles(self.model_input(img, 0))
+
+        if self.postprocess_workers == 0:
+            for current_channel in range(num_channels):
+                with self.tracer.span("predict_channel", channel=current_channel) as span:
+                    labels, details = self.StarDistModel.predict_instances(self.model_input(img, current_channel), n_tiles=n_tiles)
+                    span.arrays(labels=labels)
+                image_list.append(compact_labels(labels))
+                details_list.append(details)
+
+            return image_list, details_list
+
+        # Each channel is handed to the post-processing pool as soon as the network
+        # is done with it, so the NMS overlaps the prediction of the next channel
+        def predictions():
+            for current_channel in range(num_channels):
+                with self.tracer.span("predict_channel", channel=current_channel):
+                    x = self.model_input(img, current_channel)
+                    prediction = self.StarDistModel.predict_sparse(x, n_tiles=n_tiles, show_tile_progress=False)
+                yield (img.shape[:2],) + prediction
+
+        return self.postprocess_results(predictions())
+
+
+    def segment_untiled(self, img: np.ndarray):
+        '''Same as segment_channels, but every channel goes through the network whole in
+        one forward pass (predict_batch), whether the network is the Keras model or the
+        TensorFlow Lite one. QuantizeModel.py compares the two precisions this way, so
+        only the network differs between them'''
+
+        def predictions():
+            for current_channel in range(img.shape[-1]):
+                with self.tracer.span("predict_channel", channel=current_channel):
+                    prob, dist = self.predict_batch(self.model_input(img, current_channel)[np.newaxis])
+                    prediction = sparse_prediction(img.shape[:2], prob[0], dist[0], self.StarDistModel.config.grid,
+                                                   self.StarDistModel.thresholds.prob)
+                yield (img.shape[:2],) + prediction
+
+        return self.postprocess_results(predictions())
+
+
+    def postprocess_results(self, predictions):
+        '''Splits the (labels, details) of every channel from postprocess into a list of
+        label images and a list of details'''
 
         image_list = []
         details_list = []
-        img_shape = img.shape
-        num_channels = img_shape[-1]
+        for labels, details in self.postprocess(predictions):
+            image_list.append(labels)
+            details_list.append(details)
+
+        return image_list, details_list
+
+
+    def segment_arrays(self, images: list[np.ndarray]):
+        if self.batch_size == 1:
+            return [self.segment_channels(img) for img in images]
+
+        return self.segment_batch(images)
+
+
+    def get_n_tiles(self, x: np.ndarray):
+        '''Returns the number of tiles for a model input. The plan is worked out
+        the first time an input with this shape and dtype is seen and reused after'''
+
+        key = (x.shape, x.dtype.str, self.tile_memory_mb)
+        if key not in self.tile_plans:
+            candidates = self.tile_candidates(x)
+            if self.autotune_tiles and len(candidates) > 1:
+                self.tile_plans[key] = self.autotune_n_tiles(x, candidates)
+            else:
+                self.tile_plans[key] = candidates[0]
+            print(f"Using n_tiles={self.tile_plans[key]} for images of shape {x.shape}")
+
+        return self.tile_plans[key]
+
+
+    def tile_candidates(self, x: np.ndarray):
+        '''Lists the tilings worth trying for a model input, starting with StarDist's
+        guess. With a memory budget only the tilings that fit are kept, and when
+        none fit the one with the smallest tiles is used'''
+
+        guess = tuple(self.StarDistModel._guess_n_tiles(x))
+        if self.tile_memory_mb is None and not self.autotune_tiles:
+            return [guess]
+
+        # Fewer and more tiles than the guess, only along the spatial axes
+        candidates = []
+        for factor in (0.5, 1, 2, 4):
+            n_tiles = tuple(max(1, int(np.ceil(t * factor))) if i < 2 else t for i, t in enumerate(guess))
+            if n_tiles not in candidates:
+                candidates.append(n_tiles)
+
+        if self.tile_memory_mb is None:
+            return [guess] + [n_tiles for n_tiles in candidates if n_tiles != guess]
+
+        budget = self.tile_memory_mb * 1024 ** 2
+        fitting = [n_tiles for n_tiles in candidates if self.estimate_tile_memory(x, n_tiles) <= budget]
+        if len(fitting) == 0:
+            return [candidates[-1]]
+
+        # The fewest tiles that fit is the default when not autotuning
+        return sorted(fitting, key=np.prod)
+
+
+    def estimate_tile_memory(self, x: np.ndarray, n_tiles):
+        '''Rough estimate in bytes of the memory the network needs for one tile. The
+        largest activations of the U-Net are at full resolution with unet_n_filter_base
+        channels, and the inputs and outputs are float32'''
+
+        config = self.StarDistModel.config
+        overlap = self.StarDistModel._axes_tile_overlap('YX') if np.prod(n_tiles) > 1 else (0, 0)
+        tile_pixels = np.prod([np.ceil(s / t) + 2 * o for s, t, o in zip(x.shape[:2], n_tiles, overlap)])
+
+        values_per_pixel = config.n_channel_in + 4 * config.unet_n_filter_base + 1 + config.n_rays
+        return int(tile_pixels * values_per_pixel * 4)
+
+
+    def autotune_n_tiles(self, x: np.ndarray, candidates):
+        '''Times the network on x with each candidate tiling and returns the fastest'''
+
+        # The first prediction includes one time setup, so it is not timed
+        self.StarDistModel.predict(x, n_tiles=candidates[0], show_tile_progress=False)
+
+        timings = []
+        for n_tiles in candidates:
+            start = time.perf_counter()
+            self.StarDistModel.predict(x, n_tiles=n_tiles, show_tile_progress=False)
+            timings.append(time.perf_counter() - start)
+            print(f"n_tiles={n_tiles}: {timings[-1]:.2f}s")
+
+        return candidates[int(np.argmin(timings))]
 
+
+    def settings_fingerprint(self):
+        '''Text describing the model files and every setting that changes the results,
+        used as part of the results cache key'''
+
+        model_files = [path for path in glob(os.path.join(str(self.StarDistModel.logdir), '*')) if os.path.isfile(path)]
+
+        settings = dict(model=fingerprint_files(model_files),
+                        thresholds=tuple(self.StarDistModel.thresholds),
+                        normalize_percentiles=self.normalize_percentiles,
+                        normalize_subsample=self.normalize_subsample,
+                        # Batched images are not tiled
+                        batched=self.batch_size > 1,
+                        tile_memory_mb=self.tile_memory_mb,
+                        autotune_tiles=self.autotune_tiles,
+                        # The reduced precision network gives slightly different results
+                        tflite_model=fingerprint_files([self.tflite_network.model_path]) if self.tflite_network else None,
+                        min_overlap=self.min_overlap,
+                        min_iou=self.min_iou)
+
+        return repr(sorted(settings.items()))
+
+
+    def segment_batch(self, images: list[np.ndarray]):
+        '''Segments a list of images with as few forward passes as possible. The
+        channels of all images with the same shape are stacked into batches of up
+        to batch_size, then the probability and distance maps are split again for
+        the non-maximum suppression of each channel. Returns a list of (label list,
+        details list) in the same order as images'''
+
+        # Every channel of every image is one item, grouped by the image shape
+        groups = {}
+        for i, img in enumerate(images):
+            for channel in range(img.shape[-1]):
+                groups.setdefault(img.shape[:2], []).append((i, channel))
+
+        predictions = {}
+        for shape, items in groups.items():
+            first_img, first_channel = items[0]
+            # Images that need tiling to fit in memory can not be batched
+            if np.prod(self.get_n_tiles(self.model_input(images[first_img], first_channel))) > 1:
+                continue
+
+            for start in range(0, len(items), self.batch_size):
+                batch_items = items[start:start + self.batch_size]
+                batch = np.stack([self.model_input(images[i], channel) for i, channel in batch_items])
+                with self.tracer.span("predict_batch") as span:
+                    batch_prediction = self.predict_batch(batch)
+                    span.arrays(batch=batch)
+                for item, prob, dist in zip(batch_items, *batch_prediction):
+                    # Only the pixels above the threshold are kept, as in StarDist2D.predict_sparse
+                    predictions[item] = sparse_prediction(shape, prob, dist, self.StarDistModel.config.grid,
+                                                          self.StarDistModel.thresholds.prob)
+
+        # Send every channel of the batched images through the post-processing together
+        batched = [(i, channel) for i, img in enumerate(images) if (i, 0) in predictions
+                   for channel in range(img.shape[-1])]
+        instances = self.postprocess((images[i].shape[:2],) + predictions.pop((i, channel)) for i, channel in batched)
+        instances = dict(zip(batched, instances))
+
+        results = []
+        for i, img in enumerate(images):
+            if (i, 0) not in instances:
+                results.append(self.segment_channels(img))
+                continue
+
+            image_list = []
+            details_list = []
+            for channel in range(img.shape[-1]):
+                labels, details = instances.pop((i, channel))
+                image_list.append(labels)
+                details_list.append(details)
+            results.append((image_list, details_list))
+
+        return results
+
+
+    def postprocess(self, predictions):
+        '''Runs the non-maximum suppression and label rendering for an iterable of
+        sparse (image shape, prob, dist, points) predictions. When postprocess_workers > 0
+        these run in a process pool. Returns a list of (labels, details) in the original order'''
+
+        nms_thresh = self.StarDistModel.thresholds.nms
+
+        if self.postprocess_workers == 0:
+            results = []
+            for img_shape, prob, dist, points in predictions:
+                with self.tracer.span("nms", candidates=len(points)):
+                    results.append(instances_from_prediction(img_shape, prob, dist, points, nms_thresh))
+            return results
+
+        if self.postprocess_pool is None:
+            # Spawned workers only import PostProcessing.py, not TensorFlow
+            self.postprocess_pool = ProcessPoolExecutor(max_workers=self.postprocess_workers,
+                                                        mp_context=multiprocessing.get_context('spawn'))
+
+        futures = [self.postprocess_pool.submit(instances_from_prediction, img_shape, prob, dist, points, nms_thresh)
+                   for img_shape, prob, dist, points in predictions]
+
+        return [future.result() for future in futures]
+
+
+    def close(self):
+        '''Shuts down the post-processing worker processes and closes the trace'''
+
+        if self.postprocess_pool is not None:
+            self.postprocess_pool.shutdown()
+            self.postprocess_pool = None
+
+        BaseModel.close(self)
+
+
+    def predict_batch(self, batch: np.ndarray):
+        '''Runs a single forward pass of the network on a stack of model inputs with 
+        the same shape. The batch is padded the same way StarDist2D.predict does and
+        the returned probability and distance maps still cover the padding'''
+
+        if batch.ndim == 3:
+            batch = batch[:, :, :, np.newaxis]
+
+        # Pad the end of each spatial axis so it is divisible by the network
+        div_by = self.StarDistModel._axes_div_by('YX')
+        pad = [(0, (d - s % d) % d) for s, d in zip(batch.shape[1:3], div_by)]
+        batch = np.pad(batch, [(0, 0)] + pad + [(0, 0)], mode='reflect')
+
+        if self.tflite_network is not None:
+            prob, dist = self.tflite_network.predict(batch)
+        else:
+            prob, dist = self.StarDistModel.keras_model.predict(batch, batch_size=len(batch), verbose=0)[:2]
+
+        # Avoid small dist values to prevent problems with Qhull (same as StarDist)
+        return prob[:, :, :, 0], np.maximum(1e-3, dist)
+
+
+    def model_input(self, img: np.ndarray, channel: int):
+        '''Returns a single channel of the image in the layout the network expects.
+        Models trained on three channel images get the channel repeated in every
+        plane as a read only view, so no data is copied'''
+
+        single_channel_img = img[:, :, channel]
+        n_channel_in = self.StarDistModel.config.n_channel_in
+        if n_channel_in == 1:
+            return single_channel_img
+
+        return np.broadcast_to(single_channel_img[:, :, np.newaxis], single_channel_img.shape + (n_channel_in,))
+
+
+    def segment_large_directory(self, directory, output_directory, electroporated_channel=3,
+                                block_size=4096, block_overlap=128, context=None):
+        '''Same as segment_directory for images that are too large to read into memory,
+        see segment_large_image'''
+
+        file_list = sorted(glob(os.path.join(directory, '*.tif')))
+        if len(file_list) == 0:
+            raise FileNotFoundError(f"No images found in {directory}")
+
+        os.makedirs(output_directory, exist_ok=True)
+        electroporated_idx = electroporated_channel - 1
+
+        rows = []
+        for file_path in file_list:
+            details_list, matrix = self.segment_large_image(file_path, output_directory, block_size, block_overlap, context)
+
+            rows.append(colocalization_row(file_path, matrix, cell_counts(details_list), electroporated_idx))
+
+        write_colocalization_table(output_directory, rows)
+        return rows
+
+
+    def segment_large_image(self, file_path, output_directory, block_size=4096, block_overlap=128, context=None):
+        '''Segments an image without reading it into memory. The image is memory mapped
+        and every channel goes through the network in overlapping blocks of block_size
+        pixels, with StarDist keeping each cell from the block it is fully inside of, so
+        cells on block borders are not found twice. block_overlap has to be larger than
+        the biggest cell. The labels are written straight into a memory mapped
+        <name>_labels.tif, so memory use depends on the block size and not the image size.
+        Returns the details of every channel and the colocalization matrix'''
+
+        img, channel_axis = open_large_image(file_path)
+        num_channels = img.shape[channel_axis]
+        if num_channels != 3:
+            raise ValueError("Batch mode currently only supports 3 channel images")
+
+        n_channel_in = self.StarDistModel.config.n_channel_in
+        axes = 'YX' if n_channel_in == 1 else 'YXC'
+
+        image_name = os.path.splitext(os.path.basename(file_path))[0]
+        labels_path = os.path.join(output_directory, f"{image_name}_labels.tif")
+        height, width = (s for axis, s in enumerate(img.shape) if axis != channel_axis)
+        labels = tifffile.memmap(labels_path, shape=(num_channels, height, width), dtype=np.int32)
+
+        blocks = self.large_image_blocks((height, width), block_size, block_overlap, context)
+
+        details_list = []
         for current_channel in range(num_channels):
-            # Split the original multi channel image into each individual channel
-            single_channel_img = np.zeros((img_shape[0],img_shape[1],3))
-            label_colored = np.zeros((img_shape[0],img_shape[1],3))
+            view = ChannelView(img, current_channel, channel_axis, n_channel_in, self.normalize_percentiles)
 
-            for i in range(num_channels):
-                single_channel_img[:,:,i] = img[:,:,current_channel]
+            if blocks is None:
+                # The image fits in a single block, it is segmented whole
+                x = view[:, :]
+                channel_labels, details = self.StarDistModel.predict_instances(x, n_tiles=self.get_n_tiles(x))
+                labels[current_channel] = channel_labels
+            else:
+                block_shape, block_context = blocks
+                # Every block has the same size, so the tile plan of the first one is used for all
+                n_tiles = self.get_n_tiles(view[:block_shape[0], :block_shape[1]])
 
-            labels, details = self.StarDistModel.predict_instances(single_channel_img,n_tiles = self.StarDistModel._guess_n_tiles(img))
-            label_colored[:,:,current_channel] = labels
-            image_list.append(label_colored)
+                # The channel axis of a YXC input is never split
+                if axes == 'YXC':
+                    block_shape, block_context = block_shape + (n_channel_in,), block_context + (0,)
+                _, details = self.StarDistModel.predict_instances_big(view, axes=axes, block_size=block_shape,
+                                                                      min_overlap=block_overlap, context=block_context,
+                                                                      labels_out=labels[current_channel], n_tiles=n_tiles)
+            labels.flush()
             details_list.append(details)
 
-        # Send the list of labels and the list of details for each channel to the GUI
-        self.GUI.labels_view_screen(img, image_list, details_list)
+        del labels
+
+        # Read back from disk a strip at a time for the colocalization
+        labels = tifffile.memmap(labels_path, mode='r')
+        matrix = colocalization_matrix_blocked(list(labels), min_overlap=self.min_overlap, min_iou=self.min_iou)
+        del labels
 
+        return details_list, matrix
 
-    def count_colocalized_cells(self, electroporated: np.array, marker1: np.array, marker2: np.array):
-        '''Counts the co-localization (overlap) of the electroporated cells with marker1,
-        an again with marker 2 and then divides those numbers by the total number of electroporated cells'''
 
-        # Convert each label image to a mask for use with OpenCV
-        electroporated = np.ma.asarray(electroporated, dtype=np.uint8)
-        marker1 = np.ma.asarray(marker1, dtype=np.uint8)
-        marker2 = np.ma.asarray(marker2, dtype=np.uint8)
+    def large_image_blocks(self, shape, block_size=4096, block_overlap=128, context=None):
+        '''Block size and context along Y and X for predict_instances_big. The block size
+        is shrunk to the image along each axis, on the grid of the network, as StarDist
+        needs block_overlap + 2 * context < block size <= image size. Returns None when
+        the image fits in one block or is too small for blocks, it is segmented whole then'''
 
-        electroporated = cv2.cvtColor(electroporated, cv2.COLOR_BGR2GRAY)
-        marker1 = cv2.cvtColor(marker1, cv2.COLOR_BGR2GRAY)
-        marker2 = cv2.cvtColor(marker2, cv2.COLOR_BGR2GRAY)
+        if max(shape) <= block_size:
+            return None
 
-        # Find overlapping regions
-        overlap_mask1 = cv2.bitwise_and(electroporated, marker1)
-        overlap_mask2 = cv2.bitwise_and(electroporated, marker2)
+        grid = self.StarDistModel._axes_div_by('YX')
+        if context is None:
+            context = self.StarDistModel._axes_tile_overlap('YX')
+        elif np.isscalar(context):
+            context = (context, context)
 
-        # Find contours in the overlapping regions
-        colocalize1, _ = cv2.findContours(overlap_mask1, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        colocalize2, _ = cv2.findContours(overlap_mask2, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        block_shape, block_context = [], []
+        for size, g, c in zip(shape, grid, context):
+            # StarDist rounds these up to the grid
+            c = -(-c // g) * g
+            overlap = -(-block_overlap // g) * g
+            block = min(-(-block_size // g) * g, size // g * g)
+            if block <= overlap + 2 * c:
+                return None
+            block_shape.append(block)
+            block_context.append(c)
 
-        return len(colocalize1), len(colocalize2)
\ No newline at end of file
+        return tuple(block_shape), tuple(block_context)
@@ -0,0 +1,91 @@
+import os
+import time
+from glob import glob
+from tifffile import TiffFile
+
+# Watch mode finds the images the acquisition software writes into a folder while the
+# session is running. A TIFF is written over several seconds, so a file is only handed
+# on once it has stopped changing and can be opened
+
+
+class FolderWatcher:
+    '''Polls a folder for new TIFFs. A file is ready once its size and modification
+    time have not changed for settle_seconds and tifffile can read its first page.
+    Files in skip (such as the images of an earlier run) are never returned'''
+
+    def __init__(self, directory, settle_seconds=2.0, poll_seconds=1.0, skip=()):
+        self.directory = directory
+        self.settle_seconds = settle_seconds
+        self.poll_seconds = poll_seconds
+
+        # file path -> (size, modification time, time it was first seen with them)
+        self.candidates = {}
+        # Files that were already returned, or skipped
+        self.seen = {os.path.abspath(file_path) for file_path in skip}
+
+
+    def poll(self):
+        '''Returns the files that became ready since the last poll, sorted by name'''
+
+        now = time.monotonic()
+        ready = []
+        for file_path in sorted(glob(os.path.join(self.directory, '*.tif'))):
+            file_path = os.path.abspath(file_path)
+            if file_path in self.seen:
+                continue
+
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                # Removed or renamed since the glob
+                self.candidates.pop(file_path, None)
+                continue
+
+            size, modified = stat.st_size, stat.st_mtime_ns
+            previous = self.candidates.get(file_path)
+            if previous is None or previous[:2] != (size, modified):
+                # New or still being written, start waiting again
+                self.candidates[file_path] = (size, modified, now)
+                continue
+
+            if now - previous[2] >= self.settle_seconds and is_readable(file_path):
+                del self.candidates[file_path]
+                self.seen.add(file_path)
+                ready.append(file_path)
+
+        return ready
+
+
+    def watch(self, stop_event=None, idle_timeout=None):
+        '''Yields every file as soon as it is ready. Stops when stop_event is set, or
+        when no file became ready for idle_timeout seconds (None waits forever)'''
+
+        last_ready = time.monotonic()
+        while stop_event is None or not stop_event.is_set():
+            ready = self.poll()
+            for file_path in ready:
+                yield file_path
+                if stop_event is not None and stop_event.is_set():
+                    return
+
+            if ready:
+                last_ready = time.monotonic()
+            elif idle_timeout is not None and time.monotonic() - last_ready >= idle_timeout:
+                return
+
+            if stop_event is None:
+                time.sleep(self.poll_seconds)
+            else:
+                stop_event.wait(self.poll_seconds)
+
+
+def is_readable(file_path):
+    '''Whether a TIFF can be opened and its first page decoded, a file that is still
+    being written usually fails one of the two'''
+
+    try:
+        with TiffFile(file_path) as tif:
+            tif.pages[0].asarray()
+        return True
+    except Exception:
+        return False
@@ -0,0 +1,173 @@
+import os
+import sys
+import json
+import time
+import threading
+import numpy as np
+
+# resource is not available on Windows, peak memory is left out of the trace there
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Current resident memory is read from /proc, so it is only in the trace on Linux
+STATM_PATH = "/proc/self/statm"
+
+
+class NullSpan:
+    '''Stands in for a Span when tracing is off, every method does nothing so the
+    cost of an instrumented call is one attribute lookup and one method call'''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def arrays(self, **arrays):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span:
+    '''Times one stage of the pipeline. Created by Tracer.span'''
+
+    def __init__(self, tracer, stage, fields):
+        self.tracer = tracer
+        self.record = dict(stage=stage, **fields)
+
+    def __enter__(self):
+        self.start_rss = current_rss_mb()
+        self.start_wall = time.perf_counter()
+        self.start_thread_cpu = time.thread_time()
+        self.start_process_cpu = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.record['wall_s'] = time.perf_counter() - self.start_wall
+        # CPU time of the thread that ran the stage. Work the stage hands to other
+        # threads (such as the TensorFlow thread pools) is not in it
+        self.record['thread_cpu_s'] = time.thread_time() - self.start_thread_cpu
+        # CPU time of the whole process, including prefetch threads running at the same time
+        self.record['process_cpu_s'] = time.process_time() - self.start_process_cpu
+
+        # Resident memory before and after the stage. Other threads allocate and free
+        # at the same time, so the change is only a guide to what the stage itself uses
+        end_rss = current_rss_mb()
+        self.record['rss_start_mb'] = self.start_rss
+        self.record['rss_end_mb'] = end_rss
+        self.record['rss_delta_mb'] = None if end_rss is None else end_rss - self.start_rss
+        # Largest resident memory of the process since it started, not of this stage
+        self.record['process_peak_rss_mb'] = peak_rss_mb()
+        if exc_type is not None:
+            self.record['error'] = repr(exc)
+
+        self.tracer.write(self.record)
+        return False
+
+    def arrays(self, **arrays):
+        '''Records the shape, dtype and size of the arrays a stage read or produced'''
+
+        sizes = self.record.setdefault('arrays', {})
+        for name, array in arrays.items():
+            array = np.asarray(array)
+            sizes[name] = dict(shape=list(array.shape), dtype=array.dtype.str, nbytes=int(array.nbytes))
+
+
+class Tracer:
+    '''Writes the wall time, CPU time, resident memory and array sizes of every
+    instrumented stage to a JSON lines file, one record per stage run, and keeps
+    running totals for the summary in the analysis window. With no trace_path
+    tracing is off and span returns NULL_SPAN'''
+
+    def __init__(self, trace_path=None):
+        self.enabled = trace_path is not None
+        self.trace_path = trace_path
+        self.file = None
+
+        # stage -> [runs, total wall seconds, total thread CPU seconds]
+        self.totals = {}
+        self.lock = threading.Lock()
+
+        if self.enabled:
+            self.file = open(trace_path, 'a', buffering=1)
+
+
+    def span(self, stage, **fields):
+        '''Context manager timing one run of a stage. fields (such as the image and
+        channel) are written with the record'''
+
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, stage, fields)
+
+
+    def write(self, record):
+        # Stages run on the prefetch threads too
+        with self.lock:
+            # A prefetch thread can finish a stage after the tracer was closed
+            if self.file is None:
+                return
+
+            totals = self.totals.setdefault(record['stage'], [0, 0.0, 0.0])
+            totals[0] += 1
+            totals[1] += record['wall_s']
+            totals[2] += record['thread_cpu_s']
+
+            record['time'] = time.time()
+            self.file.write(json.dumps(record) + '\n')
+
+
+    def summary(self):
+        '''Text with the number of runs, total and mean wall time and total CPU time
+        (of the threads that ran it) of every stage so far, slowest first'''
+
+        if not self.enabled:
+            return ""
+
+        with self.lock:
+            totals = sorted(self.totals.items(), key=lambda item: -item[1][1])
+
+        lines = [f"{'Stage':<24}{'Runs':>6}{'Wall (s)':>11}{'Mean (ms)':>11}{'CPU (s)':>10}"]
+        for stage, (runs, wall, cpu) in totals:
+            lines.append(f"{stage:<24}{runs:>6}{wall:>11.2f}{1000 * wall / runs:>11.1f}{cpu:>10.2f}")
+        lines.append(f"Peak memory of the process: {peak_rss_mb() or 0:.0f} MB")
+
+        return '\n'.join(lines)
+
+
+    def close(self):
+        # Under the lock, so a write from another thread is either done or sees no file
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            self.enabled = False
+
+
+def peak_rss_mb():
+    '''Largest resident memory of this process so far in MB, None where it is not available'''
+
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS and kilobytes on Linux
+    if sys.platform == 'darwin':
+        return peak / 1024 ** 2
+    return peak / 1024
+
+
+def current_rss_mb():
+    '''Resident memory of this process right now in MB, None where it is not available'''
+
+    try:
+        with open(STATM_PATH) as f:
+            resident_pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+
+    return resident_pages * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
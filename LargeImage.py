@@ -0,0 +1,72 @@
+import numpy as np
+import tifffile
+from Normalization import channel_percentiles
+
+# Access to images that are too large to read into memory. The TIFF is memory mapped
+# (or opened through tifffile's zarr store when it is compressed or tiled) and only
+# the blocks StarDist asks for are read and normalized
+
+# Largest number of pixels read from a channel to find its normalization percentiles
+MAX_PERCENTILE_SAMPLES = 2 ** 24
+
+
+def open_large_image(file_path):
+    '''Opens a TIFF without reading it. Returns the array-like image and the
+    index of its channel axis'''
+
+    try:
+        img = tifffile.memmap(file_path, mode='r')
+    except ValueError:
+        # Compressed or tiled TIFFs can not be memory mapped
+        try:
+            import zarr
+        except ImportError:
+            raise ValueError(f"{file_path} can not be memory mapped, install zarr to read it block by block")
+        img = zarr.open(tifffile.imread(file_path, aszarr=True), mode='r')
+
+    # Same rule as prepare_image, three channel images are stored channel first
+    channel_axis = 0 if img.shape[0] == 3 else img.ndim - 1
+
+    return img, channel_axis
+
+
+class ChannelView:
+    '''One channel of a large image, normalized and laid out the way the network
+    expects, that is only read from disk when a block of it is indexed. Used as the
+    input of StarDist2D.predict_instances_big'''
+
+    def __init__(self, img, channel, channel_axis, n_channel_in, percentiles=(1, 99.8), eps=1e-20):
+        self.img = img
+        self.channel = channel
+        self.channel_axis = channel_axis
+        self.n_channel_in = n_channel_in
+
+        spatial_shape = tuple(s for axis, s in enumerate(img.shape) if axis != channel_axis)
+        self.shape = spatial_shape if n_channel_in == 1 else spatial_shape + (n_channel_in,)
+        self.ndim = len(self.shape)
+        self.dtype = np.dtype(np.float32)
+
+        # The percentiles come from an evenly spaced sample of the whole channel
+        subsample = max(1, int(np.ceil(np.sqrt(np.prod(spatial_shape) / MAX_PERCENTILE_SAMPLES))))
+        sample = np.asarray(self.img[self.channel_index(slice(None, None, subsample), slice(None, None, subsample))])
+        mi, ma = channel_percentiles(sample, percentiles)
+        self.mi = np.float32(mi)
+        self.scale = np.float32(ma) - self.mi + np.float32(eps)
+
+    def channel_index(self, rows, cols):
+        '''Index into the full image for a region of this channel'''
+
+        index = [rows, cols]
+        index.insert(self.channel_axis, self.channel)
+        return tuple(index)
+
+    def __getitem__(self, index):
+        index = index if isinstance(index, tuple) else (index,)
+        rows, cols = (tuple(index) + (slice(None), slice(None)))[:2]
+
+        block = np.asarray(self.img[self.channel_index(rows, cols)])
+        block = (block.astype(np.float32) - self.mi) / self.scale
+
+        if self.n_channel_in == 1:
+            return block
+        return np.broadcast_to(block[:, :, np.newaxis], block.shape + (self.n_channel_in,))
@@ -1,64 +1,358 @@
 import os
+import queue
+import threading
 import tkinter as tk
 from tkinter import filedialog, messagebox, ttk
 from glob import glob
 from tifffile import imread
-from CustomStarDistFile import CustomStarDist
+from tqdm import tqdm
 from AppGUI import SegmentAppGUI
+from BaseModelInterface import MODEL_BACKENDS, get_backend, create_model
+from BatchPipeline import IncrementalResults, segment_watched_image
+from FolderWatcher import FolderWatcher
+
+# Segmentation results are cached here, so re-opening a folder only segments new or changed images
+RESULTS_CACHE_DIRECTORY = os.path.join(os.path.expanduser("~"), ".cell_segmentation_cache")
+
+# Set CELL_SEGMENTATION_TRACE to a file path to record the time and memory of every stage
+TRACE_PATH = os.environ.get("CELL_SEGMENTATION_TRACE")
+
+# How often the UI checks on a model being loaded in the background
+MODEL_LOAD_POLL_MS = 100
+
+# Number of segmented images that wait for review in the app while the next ones are
+# segmented, each holds the image and its labels in memory
+REVIEW_QUEUE_SIZE = 3
+
+# How often the app checks for the next segmented image and updates the progress
+RESULT_POLL_MS = 200
+
+# Folder inside a watched folder that the app saves its results to
+WATCH_RESULTS_FOLDER = "segmentation_results"
 
 
 class CellSegmentationApp:
     def __init__(self, root):
-        
-        # Initialize model placeholder
-        self.MODEL_OPTIONS = [
-            "Custom StarDist Model"
-        ]
+        self.root = root
+
+        # Model menu, one entry per registered backend
+        self.backend_names = list(MODEL_BACKENDS)
+        self.MODEL_OPTIONS = [MODEL_BACKENDS[name]['display_name'] for name in self.backend_names]
+        self.backend = self.backend_names[0]
 
         self.model = None
         self.model_path = None
         self.image_path = None
 
+        # Whether the app is in watch mode, see watch_images
+        self.watching = False
+
+        # Progress messages and the result of the background model load
+        self.model_load_queue = queue.Queue()
+
         self.GUI = SegmentAppGUI(root, self.MODEL_OPTIONS, self)
         self.GUI.show_startup_screen()
 
 
+    def select_backend(self, index):
+        '''Stores the backend chosen in the model menu, then asks for the model folder
+        if the backend has model files or loads it straight away if not'''
+
+        self.backend = self.backend_names[index]
+        if MODEL_BACKENDS[self.backend]['needs_model_path']:
+            self.GUI.model_run_screen()
+        else:
+            self.load_model(None)
+
+
     def load_model(self, model_path):
         '''Send the required information to the constructor of the
-        Stardist Model File'''
+        selected backend'''
 
-        # Get the model path from the entry
-        base_directory = os.path.dirname(model_path)
-        model_name = os.path.basename(model_path)
-        if not model_path:
-            messagebox.showerror("Error", "Please enter a directory path.")
-            return
-        if not model_name:
-            messagebox.showerror("Error", "Please enter the name of your model")
+        display_name = MODEL_BACKENDS[self.backend]['display_name']
+        if MODEL_BACKENDS[self.backend]['needs_model_path']:
+            # Get the model path from the entry
+            model_name = os.path.basename(model_path)
+            if not model_path:
+                messagebox.showerror("Error", "Please enter a directory path.")
+                return
+            if not model_name:
+                messagebox.showerror("Error", "Please enter the name of your model")
+                return
+            display_name = model_name
+
+        # The model is built in the background so the window keeps responding,
+        # TensorFlow is only imported once the first model is chosen
+        self.GUI.model_loading_screen(display_name)
+        threading.Thread(target=self.build_model, args=(self.backend, model_path), daemon=True).start()
+        self.root.after(MODEL_LOAD_POLL_MS, self.check_model_loaded)
+
+
+    def build_model(self, backend, model_path):
+        '''Imports the backend, builds the model and runs it once. Runs on a background
+        thread, so it only talks to the UI through model_load_queue'''
 
-        # Initialize the model and save a reference for it 
         try:
-            self.model = CustomStarDist(model_name, base_directory, root, self.GUI)
-            messagebox.showinfo("Success", "Model initialized successfully!")
-            self.GUI.image_input_screen()
+            self.model_load_queue.put(("progress", "Importing the segmentation libraries..."))
+            get_backend(backend)
+
+            self.model_load_queue.put(("progress", "Loading the model..."))
+            model = create_model(backend, model_path, cache_directory=RESULTS_CACHE_DIRECTORY, trace_path=TRACE_PATH)
+
+            self.model_load_queue.put(("progress", "Warming up the model..."))
+            model.warm_up()
+
+            self.model_load_queue.put(("done", model))
         except Exception as e:
-            messagebox.showerror("Error", f"Failed to Initialize Model: {e}")
-            return
+            self.model_load_queue.put(("error", e))
+
+
+    def check_model_loaded(self):
+        '''Shows the progress of the background model load, and moves on to the
+        image screen once it is done'''
+
+        while True:
+            try:
+                kind, value = self.model_load_queue.get_nowait()
+            except queue.Empty:
+                break
+
+            if kind == "progress":
+                self.GUI.update_model_loading_screen(value)
+            elif kind == "done":
+                self.model = value
+                self.GUI.stop_model_loading_screen()
+                messagebox.showinfo("Success", "Model initialized successfully!")
+                self.GUI.image_input_screen()
+                return
+            else:
+                self.GUI.stop_model_loading_screen()
+                messagebox.showerror("Error", f"Failed to Initialize Model: {value}")
+                if MODEL_BACKENDS[self.backend]['needs_model_path']:
+                    self.GUI.model_run_screen()
+                else:
+                    self.GUI.clear_current_screen()
+                    self.GUI.show_startup_screen()
+                return
+
+        self.root.after(MODEL_LOAD_POLL_MS, self.check_model_loaded)
         
 
-    def send_images(self,directory):
+    def send_images(self,directory, watch=False):
         '''Send the images to the model, where it will then segment them
-        and communicate that with the APPGUI'''
+        and communicate that with the APPGUI. With watch the folder is
+        watched for new images until the user stops it'''
 
         # Get the directory path from the entry
         if not directory:
             messagebox.showerror("Error", "Please enter a directory path.")
             return
 
+        if watch:
+            print(f"Watching {directory}")
+            self.watch_images(directory)
+            return
+
         # Read and process images
         print("Sending Images")
-        self.model.load_images(directory)
-        
+        self.load_images(directory)
+
+
+    def load_images(self,directory):
+        '''Finds the images in a directory, they are then read one at a time
+        as they are passed through the model'''
+
+        print("Loading Images")
+        messagebox.showinfo("Loading Images")
+        # Find Images, they are read (and traced) one at a time by the worker
+        self.file_list = sorted(glob(f'{directory}/*.tif'))
+        if len(self.file_list) == 0:
+            messagebox.showinfo("No Images", "No images found in the specified directory.")
+            return
+
+        self.run_model()
+
+
+    def run_model(self):
+        '''Starts segmenting the images on a background thread and shows the first one
+        in the viewer once it is ready. Finished images wait in a bounded queue while
+        the user reviews, so the model keeps working instead of waiting for the viewer'''
+
+        try:
+            images = self.model.start_image_stream(self.file_list)
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to read images: {e}")
+            return
+
+        self.watching = False
+        # Create counter for analytics screen to keep track 
+        # of what row in the table we are on
+        self.img_count = 0
+        # Number of images the worker has finished, read by the UI for the progress
+        self.num_segmented = 0
+        self.worker_finished = False
+        self.results_queue = queue.Queue(maxsize=REVIEW_QUEUE_SIZE)
+
+        # Create the Analytics Screen
+        self.GUI.create_analytics_screen(self.file_list, self.model.n_channel, self.model)
+
+        threading.Thread(target=self.segment_worker, args=(images,), daemon=True).start()
+        self.show_next_result()
+        self.track_progress()
+
+
+    def segment_worker(self, images):
+        '''Runs on the background thread, puts every segmented image on the results
+        queue followed by "done", or "error" if segmentation fails. Tk is not thread
+        safe, so everything shown to the user goes through the queue'''
+
+        try:
+            for file_path, img, image_list, details_list, matrix in self.model.segment_stream(tqdm(images, total=len(self.file_list))):
+                # Measured here rather than when the image is shown, it takes a while on dense images
+                cells = self.model.measure_cells(file_path, image_list, details_list)
+                self.num_segmented += 1
+                # Waits here while the queue is full, so only REVIEW_QUEUE_SIZE images are held
+                self.results_queue.put(("result", (img, image_list, details_list, matrix, cells)))
+        except Exception as e:
+            self.worker_finished = True
+            self.results_queue.put(("error", e))
+            return
+
+        self.worker_finished = True
+        self.results_queue.put(("done", None))
+
+
+    def show_next_result(self):
+        '''Shows the next segmented image in the viewer, called when the app starts and
+        whenever the viewer is closed. Checks again shortly if the worker is not done
+        with the next image yet'''
+
+        if self.watching:
+            self.show_latest_result()
+            return
+
+        try:
+            kind, value = self.results_queue.get_nowait()
+        except queue.Empty:
+            self.root.after(RESULT_POLL_MS, self.show_next_result)
+            return
+
+        if kind == "error":
+            messagebox.showerror("Error", f"Failed to segment images: {value}")
+            return
+        if kind == "done":
+            self.GUI.update_segmentation_progress(self.num_segmented, self.img_count, len(self.file_list))
+            return
+
+        # Index to be used by the GUI, image_count starts at 1
+        self.img_count += 1
+
+        # Send the list of labels and the list of details for each channel to the GUI
+        img, image_list, details_list, matrix, cells = value
+        self.GUI.labels_view_screen(img, image_list, details_list, matrix, cells)
+
+
+    def track_progress(self):
+        '''Keeps the progress shown in the app up to date until the worker is finished'''
+
+        self.GUI.update_segmentation_progress(self.num_segmented, self.img_count, len(self.file_list))
+        if not self.worker_finished:
+            self.root.after(RESULT_POLL_MS, self.track_progress)
+
+
+    def watch_images(self, directory):
+        '''Watch mode of the app. Images are segmented on a background thread as soon
+        as the acquisition software has finished writing them into the directory, and
+        each one is added to the analysis table and to the tables in the results folder
+        of the directory right away, without waiting for it to be reviewed. The viewer
+        always moves on to the newest image'''
+
+        self.watch_output = os.path.join(directory, WATCH_RESULTS_FOLDER)
+        os.makedirs(self.watch_output, exist_ok=True)
+        self.watch_results = IncrementalResults(self.watch_output)
+        watcher = FolderWatcher(directory, skip=[os.path.join(directory, name) for name in self.watch_results.done])
+
+        self.watching = True
+        self.stop_watching = threading.Event()
+        # Filled in as images arrive, the analysis window holds on to the same list
+        self.file_list = []
+        self.img_count = 0
+        self.num_segmented = 0
+        self.worker_finished = False
+        # Only the newest image is kept for the viewer, the others are in the table
+        self.latest_result = None
+        self.viewer_waiting = True
+        # Not bounded, the UI takes every result off straight away
+        self.results_queue = queue.Queue()
+
+        # The app only supports 3 channel images, others are skipped as they arrive
+        self.GUI.create_analytics_screen(self.file_list, 3, self.model, watching=True)
+
+        threading.Thread(target=self.watch_worker, args=(watcher,), daemon=True).start()
+        self.collect_watched_results()
+
+
+    def watch_worker(self, watcher):
+        '''Runs on the background thread in watch mode until stop_watching is set'''
+
+        try:
+            for file_path in watcher.watch(self.stop_watching):
+                try:
+                    row, cells, result = segment_watched_image(self.model, file_path, self.watch_output)
+                except Exception as e:
+                    self.results_queue.put(("error", (file_path, e)))
+                    continue
+                self.results_queue.put(("result", (row, cells, result)))
+        except Exception as e:
+            self.results_queue.put(("error", (self.watch_output, e)))
+        finally:
+            self.worker_finished = True
+
+
+    def collect_watched_results(self):
+        '''Adds every image the watch worker finished to the table and the results
+        files, and opens the viewer if it is waiting for an image'''
+
+        while True:
+            try:
+                kind, value = self.results_queue.get_nowait()
+            except queue.Empty:
+                break
+
+            if kind == "error":
+                # A bad file should not end the session
+                print(f"Failed to segment {value[0]}: {value[1]}")
+                continue
+
+            row, cells, result = value
+            self.file_list.append(result[0])
+            self.num_segmented += 1
+            self.watch_results.add(row, cells)
+            self.GUI.add_watched_result(len(self.file_list), row, cells)
+            self.latest_result = (len(self.file_list), result)
+
+        if self.viewer_waiting and self.latest_result is not None:
+            self.show_latest_result()
+
+        self.GUI.update_segmentation_progress(self.num_segmented, self.img_count, None)
+        if self.worker_finished and self.results_queue.empty():
+            self.watch_results.close()
+        else:
+            self.root.after(RESULT_POLL_MS, self.collect_watched_results)
+
+
+    def show_latest_result(self):
+        '''Shows the newest image in the viewer, or waits for the next one to arrive'''
+
+        if self.latest_result is None:
+            self.viewer_waiting = True
+            return
+
+        self.viewer_waiting = False
+        self.img_count, (_, img, image_list, details_list, matrix) = self.latest_result
+        self.latest_result = None
+        self.GUI.labels_view_screen(img, image_list, details_list, matrix)
+
 
 if __name__ == "__main__":
     root = tk.Tk()
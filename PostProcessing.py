@@ -0,0 +1,46 @@
+import numpy as np
+from stardist import polygons_to_label, dist_to_coord
+from stardist.nms import non_maximum_suppression_sparse
+
+# This file only depends on numpy and the compiled parts of StarDist (no TensorFlow),
+# so the functions in it can be run in worker processes that start up quickly
+
+
+def instances_from_prediction(img_shape, prob, dist, points, nms_thresh):
+    '''Non-maximum suppression and label rendering for the sparse prediction of
+    a single channel, the same as StarDist2D.predict_instances does after the 
+    network. Returns the label image and the details dictionary (coord, points, prob)'''
+
+    points, probi, disti, _ = non_maximum_suppression_sparse(dist, prob, points, nms_thresh=nms_thresh)
+
+    labels = polygons_to_label(disti, points, prob=probi, shape=img_shape)
+    coord = dist_to_coord(disti, points)
+
+    return compact_labels(labels), dict(coord=coord, points=points, prob=probi)
+
+
+def sparse_prediction(img_shape, prob, dist, grid, prob_thresh, b=2):
+    '''Keeps only the pixels of a dense (prob, dist) prediction that are above the
+    probability threshold and at least b pixels away from the border, the same as
+    StarDist2D.predict_sparse. prob and dist can include the padding added before
+    the network, points that fall in the padding are dropped. Returns (prob, dist,
+    points) of the remaining pixels'''
+
+    inds = prob > prob_thresh
+    border = np.zeros_like(inds)
+    border[b:-b, b:-b] = True
+    inds &= border
+
+    points = np.stack(np.where(inds), axis=1) * np.array(grid).reshape((1, 2))
+    inside = np.all(points < np.array(img_shape).reshape((1, 2)), axis=1)
+
+    return prob[inds][inside], dist[inds][inside], points[inside]
+
+
+def compact_labels(labels: np.ndarray):
+    '''Stores a label image as uint16 when it has few enough cells, otherwise
+    it is kept as the int32 image returned by StarDist'''
+
+    if labels.max(initial=0) <= np.iinfo(np.uint16).max:
+        return labels.astype(np.uint16)
+    return labels
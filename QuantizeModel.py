@@ -0,0 +1,136 @@
+import os
+import json
+import time
+import argparse
+from glob import glob
+import numpy as np
+from BatchPipeline import cell_counts, colocalization_ratios
+from CustomStarDistFile import CustomStarDist
+from TFLiteInference import PRECISIONS, export_tflite, calibration_inputs
+
+# Exports the network of a StarDist model to TensorFlow Lite at reduced precision, then
+# segments a few images with both networks and reports how much the cell counts and
+# colocalization ratios change and how much faster the exported network is. Use the
+# exported file with BatchSegment.py --tflite-model once the report looks acceptable
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Export a StarDist model to TensorFlow Lite and compare it with the float32 model")
+    parser.add_argument("model", help="Folder in which your model files are contained")
+    parser.add_argument("images", help="Folder of images used for calibration and the accuracy report")
+    parser.add_argument("output", help="TensorFlow Lite file to write")
+    parser.add_argument("--precision", default="float16", choices=PRECISIONS,
+                        help="float16 halves the weights, int8 also quantizes the activations using calibration images")
+    parser.add_argument("--calibration-samples", type=int, default=32,
+                        help="Number of random single channel crops used to calibrate int8")
+    parser.add_argument("--calibration-crop", type=int, default=256,
+                        help="Side length in pixels of the calibration crops")
+    parser.add_argument("--report-images", type=int, default=5,
+                        help="Number of images segmented with both networks for the accuracy report")
+    parser.add_argument("--electroporated-channel", type=int, default=3, choices=[1, 2, 3],
+                        help="Channel (starting at 1) that holds the electroporated cells")
+    parser.add_argument("--intra-op-threads", type=int, default=None,
+                        help="Threads used inside one network operation, by both networks")
+    parser.add_argument("--inter-op-threads", type=int, default=None,
+                        help="Network operations TensorFlow runs at the same time")
+    parser.add_argument("--report", default=None,
+                        help="json file for the accuracy report (default is the output file with .report.json)")
+
+    return parser.parse_args(argv)
+
+
+def accuracy_report(reference, candidate, file_paths, electroporated_idx=2):
+    '''Segments every image with the reference (float32) and the candidate model and
+    compares the number of cells in every channel and the colocalization ratios.
+    Both run the whole image through their network without tiling (segment_untiled),
+    so the times and counts only differ by the precision of the network. Returns one
+    row per image and a summary'''
+
+    warmed_up = set()
+    rows = []
+    for file_path in file_paths:
+        img = reference.prepare_image(file_path)
+
+        # The first pass on a new input size sets up the network for it (Keras traces
+        # it, the interpreter resizes its tensors), which is left out of the times
+        if img.shape not in warmed_up:
+            for model in (reference, candidate):
+                model.predict_batch(model.model_input(img, 0)[np.newaxis])
+            warmed_up.add(img.shape)
+
+        results = {}
+        for name, model in (("float32", reference), ("reduced", candidate)):
+            start = time.perf_counter()
+            image_list, details_list = model.segment_untiled(img)
+            seconds = time.perf_counter() - start
+
+            counts = cell_counts(details_list)
+            matrix = model.colocalization_matrix(image_list)
+            ratio1, ratio2, _ = colocalization_ratios(matrix, counts, electroporated_idx)
+            results[name] = dict(seconds=seconds, cell_counts=counts, ratios=[float(ratio1), float(ratio2)])
+
+        reference_counts = np.array(results["float32"]["cell_counts"])
+        candidate_counts = np.array(results["reduced"]["cell_counts"])
+        rows.append(dict(file_name=os.path.basename(file_path),
+                         **results,
+                         # Relative change of the number of cells of every channel
+                         count_change=((candidate_counts - reference_counts) / np.maximum(reference_counts, 1)).tolist(),
+                         ratio_change=(np.array(results["reduced"]["ratios"]) - results["float32"]["ratios"]).tolist()))
+
+    summary = dict(max_abs_count_change=max(np.abs(row['count_change']).max() for row in rows),
+                   max_abs_ratio_change=max(np.abs(row['ratio_change']).max() for row in rows),
+                   float32_seconds=sum(row['float32']['seconds'] for row in rows),
+                   reduced_seconds=sum(row['reduced']['seconds'] for row in rows))
+    summary['speedup'] = summary['float32_seconds'] / summary['reduced_seconds']
+
+    return rows, summary
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    file_list = sorted(glob(os.path.join(args.images, '*.tif')))
+    if len(file_list) == 0:
+        raise FileNotFoundError(f"No images found in {args.images}")
+
+    model_path = os.path.normpath(args.model)
+    model_name, base_directory = os.path.basename(model_path), os.path.dirname(model_path)
+    threads = dict(intra_op_threads=args.intra_op_threads, inter_op_threads=args.inter_op_threads)
+    reference = CustomStarDist(model_name, base_directory, prefetch_workers=0, **threads)
+
+    calibration = None
+    if args.precision == "int8":
+        calibration = calibration_inputs(reference, file_list, args.calibration_samples, args.calibration_crop)
+        print(f"Calibrating with {len(calibration)} crops")
+
+    num_bytes = export_tflite(reference.StarDistModel.keras_model, args.output, args.precision, calibration)
+    print(f"Saved the {args.precision} network to {args.output} ({num_bytes / 1024 ** 2:.1f} MB)")
+
+    # Both share the loaded StarDist model, only the network differs
+    candidate = CustomStarDist(model_name, base_directory, prefetch_workers=0, tflite_model=args.output, **threads)
+
+    report_files = file_list[:args.report_images]
+    rows, summary = accuracy_report(reference, candidate, report_files, args.electroporated_channel - 1)
+
+    print(f"{'Image':<24}{'Cells float32':>22}{'Cells ' + args.precision:>22}{'Ratios float32':>18}{'Ratios ' + args.precision:>18}")
+    for row in rows:
+        print(f"{row['file_name']:<24}{str(row['float32']['cell_counts']):>22}{str(row['reduced']['cell_counts']):>22}"
+              f"{'%.2f %.2f' % tuple(row['float32']['ratios']):>18}{'%.2f %.2f' % tuple(row['reduced']['ratios']):>18}")
+    print(f"Largest change in cell count {summary['max_abs_count_change'] * 100:.2f} %, "
+          f"in a colocalization ratio {summary['max_abs_ratio_change']:.4f}")
+    print(f"Segmentation took {summary['float32_seconds']:.2f} s with float32 and {summary['reduced_seconds']:.2f} s "
+          f"with {args.precision} ({summary['speedup']:.2f}x)")
+
+    report_path = args.report or f"{os.path.splitext(args.output)[0]}.report.json"
+    with open(report_path, 'w') as f:
+        json.dump(dict(model=model_path, tflite_model=args.output, precision=args.precision,
+                       size_mb=num_bytes / 1024 ** 2, calibration_samples=len(calibration or []),
+                       threads=threads, images=rows, summary=summary), f, indent=2)
+    print(f"Saved the report to {report_path}")
+
+    reference.close()
+    candidate.close()
+
+
+if __name__ == "__main__":
+    main()
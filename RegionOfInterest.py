@@ -0,0 +1,107 @@
+import json
+import numpy as np
+from skimage.measure import points_in_poly
+
+
+class RegionOfInterest:
+    '''A rectangle or polygon region of an image. The vertices are (x, y) pixel
+    coordinates of the full image, a rectangle is stored as its four corners'''
+
+    def __init__(self, vertices):
+        self.vertices = np.asarray(vertices, dtype=float).reshape(-1, 2)
+
+
+    def bounds(self, shape):
+        '''(top, left, bottom, right) of the region, clipped to an image of shape (H, W)'''
+
+        height, width = shape
+        left, top = np.floor(self.vertices.min(axis=0)).astype(int)
+        right, bottom = np.ceil(self.vertices.max(axis=0)).astype(int)
+
+        return max(0, top), max(0, left), min(height, bottom), min(width, right)
+
+
+    def contains(self, points):
+        '''Which (y, x) points are inside the region'''
+
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        return points_in_poly(points[:, ::-1], self.vertices)
+
+
+    def to_json(self):
+        return dict(polygon=self.vertices.tolist())
+
+
+    def __repr__(self):
+        return f"RegionOfInterest({self.vertices.tolist()})"
+
+
+def rectangle(left, top, right, bottom):
+    return RegionOfInterest([(left, top), (right, top), (right, bottom), (left, bottom)])
+
+
+def parse_rectangle(text):
+    '''Rectangle from "left,top,right,bottom" as given on the command line'''
+
+    left, top, right, bottom = (float(value) for value in text.split(','))
+    return rectangle(left, top, right, bottom)
+
+
+def roi_from_json(entry):
+    '''Region from {"rectangle": [left, top, right, bottom]} or {"polygon": [[x, y], ...]}'''
+
+    if 'rectangle' in entry:
+        return rectangle(*entry['rectangle'])
+    return RegionOfInterest(entry['polygon'])
+
+
+def load_roi_file(file_path):
+    '''Reads a json file mapping image file names to a list of regions. The regions
+    under "*" are used for every image that is not listed'''
+
+    with open(file_path) as f:
+        entries = json.load(f)
+
+    return {image_name: [roi_from_json(entry) for entry in rois] for image_name, rois in entries.items()}
+
+
+def inside_any(rois, points):
+    '''Which (y, x) points are inside at least one of the regions'''
+
+    inside = np.zeros(len(points), dtype=bool)
+    for roi in rois:
+        inside |= roi.contains(points)
+    return inside
+
+
+def crop_windows(rois, shape, padding, align=1):
+    '''Bounding boxes (top, left, bottom, right) of the regions grown by padding on
+    every side, so cells on the edge of a region are segmented whole. The top left
+    corner is moved to a multiple of align, so a network with a coarser output grid
+    sees the crop on the same grid as the whole image. Boxes that overlap are
+    merged, so no pixel is segmented twice'''
+
+    height, width = shape
+    windows = []
+    for roi in rois:
+        top, left, bottom, right = roi.bounds(shape)
+        if bottom > top and right > left:
+            windows.append([max(0, top - padding) // align * align, max(0, left - padding) // align * align,
+                            min(height, bottom + padding), min(width, right + padding)])
+
+    # Keep merging until no two boxes overlap, a merged box can reach a third one
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(windows)):
+            for j in range(i + 1, len(windows)):
+                a, b = windows[i], windows[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    windows[i] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                    del windows[j]
+                    merged = True
+                    break
+            if merged:
+                break
+
+    return [tuple(window) for window in windows]
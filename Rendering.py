@@ -0,0 +1,98 @@
+import numpy as np
+from PIL import Image
+
+# Compositing of the image viewer in uint8 numpy arrays, kept apart from the Tk
+# widgets in AppGUI.py so the benchmark and tests can run it without a display.
+# The viewer builds a render cache at the canvas size once per image, and every
+# redraw only composites the cached layers
+
+
+def to_uint8(img: np.ndarray):
+    '''Converts a normalized image to uint8, values outside of 0 to 1 are clipped'''
+
+    return (np.clip(img, 0, 1) * 255).astype(np.uint8)
+
+
+def label_lut(alpha, max_label):
+    '''Lookup table from a label value to the brightness it adds to the color plane
+    of its channel, the same as adding alpha * label to the normalized image'''
+
+    return np.minimum(np.arange(max_label + 1) * (alpha * 255), 255).astype(np.uint8)
+
+
+def label_boundaries(labels: np.ndarray):
+    '''Pixels on the edge of a cell, where a 4-neighbour has another label. Both sides of
+    a border between touching cells are marked so each cell keeps a closed outline. The
+    mask is packed 8 pixels per byte along the rows, see unpack_mask'''
+
+    edge = np.zeros(labels.shape, dtype=bool)
+
+    vertical = labels[1:] != labels[:-1]
+    edge[1:] |= vertical
+    edge[:-1] |= vertical
+
+    horizontal = labels[:, 1:] != labels[:, :-1]
+    edge[:, 1:] |= horizontal
+    edge[:, :-1] |= horizontal
+
+    edge &= labels > 0
+    return np.packbits(edge, axis=1)
+
+
+def unpack_mask(packed: np.ndarray, width):
+    return np.unpackbits(packed, axis=1, count=width).view(bool)
+
+
+def composite_layers(gray_layers, label_layers, selected, luts, outline_layers=None):
+    '''Composites the viewer image in uint8. The background is the mean of the selected
+    grayscale channels, each selected channel's labels are added to its color plane 
+    through its lookup table, and pixels labelled in every selected channel are gold.
+    With outline_layers (packed masks from label_boundaries) the outline of every cell
+    is drawn in its channel's color instead, and the cells are not filled'''
+
+    selected_idx = [i for i, is_selected in enumerate(selected) if is_selected]
+    shape = label_layers[0].shape
+
+    # If no channels are selected, show a black screen
+    if len(selected_idx) == 0:
+        return np.zeros(shape + (3,), dtype=np.uint8)
+
+    # Accumulate in uint16 and clip once at the end
+    gray = sum(gray_layers[i].astype(np.uint16) for i in selected_idx) // len(selected_idx)
+    composite = np.repeat(gray[:, :, np.newaxis], 3, axis=2)
+
+    if outline_layers is not None:
+        for i in selected_idx:
+            composite[:, :, i][unpack_mask(outline_layers[i], shape[1])] = 255
+        return composite.astype(np.uint8)
+
+    overlap = np.ones(shape, dtype=bool)
+    for i in selected_idx:
+        composite[:, :, i] += luts[i][label_layers[i]]
+        overlap &= label_layers[i] > 0
+
+    if len(selected_idx) > 1:
+        composite[:, :, 0] += overlap * np.uint16(255)
+        composite[:, :, 1] += overlap * np.uint16(216)
+
+    return np.minimum(composite, 255).astype(np.uint8)
+
+
+def render_cache(image: np.ndarray, label_images, width, height):
+    '''Downsamples the grayscale image and the labels of every channel to the
+    display size once per image. Returns the grayscale layers, the labels and the
+    packed outline masks at that size, the layers composite_layers takes'''
+
+    gray_layers = to_uint8(image)
+    display_gray = [np.asarray(Image.fromarray(np.ascontiguousarray(gray_layers[:,:,i]))
+                               .resize((width, height), Image.LANCZOS))
+                    for i in range(len(label_images))]
+
+    # Labels are sampled with nearest neighbour so the label values are kept
+    rows = np.arange(height) * image.shape[0] // height
+    cols = np.arange(width) * image.shape[1] // width
+    display_labels = [labels[np.ix_(rows, cols)] for labels in label_images]
+    # Outlines are found once per image at the display size, toggling them only composites
+    display_outlines = [label_boundaries(labels) for labels in display_labels]
+
+    return display_gray, display_labels, display_outlines
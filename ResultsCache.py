@@ -0,0 +1,107 @@
+import os
+import hashlib
+import numpy as np
+
+
+class ResultsCache:
+    '''On disk cache of segmentation results. Each entry is keyed by the content of the
+    image file and a fingerprint of everything else that changes the result (model
+    weights and config, normalization and tiling settings), so an image is only
+    segmented again when the file or the settings change. The least recently used
+    entries are removed once the cache is larger than max_size_mb'''
+
+    def __init__(self, directory, settings_fingerprint, max_size_mb=2048):
+        self.directory = directory
+        self.settings_fingerprint = settings_fingerprint
+        self.max_size = max_size_mb * 1024 ** 2
+
+        os.makedirs(self.directory, exist_ok=True)
+
+
+    def image_key(self, file_path, extra=""):
+        '''Hash of the image file's content together with the settings fingerprint, and
+        anything else that changes the result of this one image'''
+
+        digest = hashlib.sha256(self.settings_fingerprint.encode())
+        digest.update(extra.encode())
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 ** 2), b''):
+                digest.update(chunk)
+
+        return digest.hexdigest()
+
+
+    def load(self, key):
+        '''Returns the cached (label list, details list, colocalization matrix) for
+        a key, or None if it has not been cached'''
+
+        entry_path = self.entry_path(key)
+        try:
+            with np.load(entry_path) as entry:
+                num_channels = int(entry['num_channels'])
+                image_list = [entry[f'labels_{c}'] for c in range(num_channels)]
+                details_list = [dict(coord=entry[f'coord_{c}'], points=entry[f'points_{c}'], prob=entry[f'prob_{c}'])
+                                for c in range(num_channels)]
+                matrix = entry['colocalization_matrix']
+        except (OSError, KeyError, ValueError):
+            # Missing, or partly written by a run that was killed
+            return None
+
+        # Mark the entry as recently used for the eviction
+        os.utime(entry_path)
+
+        return image_list, details_list, matrix
+
+
+    def save(self, key, image_list, details_list, matrix):
+        '''Stores the compressed results of one image, then evicts old entries'''
+
+        arrays = dict(num_channels=len(image_list), colocalization_matrix=matrix)
+        for c, (labels, details) in enumerate(zip(image_list, details_list)):
+            arrays[f'labels_{c}'] = labels
+            arrays[f'coord_{c}'] = details['coord']
+            arrays[f'points_{c}'] = details['points']
+            arrays[f'prob_{c}'] = details['prob']
+
+        # Written under a temporary name first so readers never see half an entry
+        entry_path = self.entry_path(key)
+        temp_path = f"{entry_path}.{os.getpid()}.tmp"
+        with open(temp_path, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(temp_path, entry_path)
+
+        self.evict()
+
+
+    def evict(self):
+        '''Removes the least recently used entries until the cache fits in max_size_mb'''
+
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.npz'):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            os.remove(os.path.join(self.directory, name))
+            total_size -= size
+
+
+    def entry_path(self, key):
+        return os.path.join(self.directory, f"{key}.npz")
+
+
+def fingerprint_files(paths):
+    '''Hash of the content of a list of files, used to tell when model weights change'''
+
+    digest = hashlib.sha256()
+    for path in sorted(paths):
+        digest.update(os.path.basename(path).encode())
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 ** 2), b''):
+                digest.update(chunk)
+
+    return digest.hexdigest()
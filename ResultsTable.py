@@ -0,0 +1,76 @@
+import csv
+import numpy as np
+
+# Columns of the colocalization table, shared by the app and batch mode
+COLOCALIZATION_COLUMNS = ["File Name",
+                          "Ratio of electroporated with 1",
+                          "Ratio of electroporated with 2",
+                          "# cells in electroporated"]
+
+# Columns of the table with one row per cell, CellFeatures adds the measurements
+CELL_COLUMNS = ["File Name", "Channel", "Cell", "Y", "X", "Probability"]
+
+
+class ResultsTable:
+    '''In memory table stored as one list per column, with one row per key (such as
+    the image name). Setting a row that already exists replaces it, so a row can be
+    updated when the user picks another electroporated channel'''
+
+    def __init__(self, columns):
+        self.columns = list(columns)
+        self.data = {name: [] for name in self.columns}
+        # key -> row index
+        self.rows = {}
+
+
+    def __len__(self):
+        return len(self.data[self.columns[0]])
+
+
+    def set_row(self, key, values):
+        '''Adds or replaces the row of key, returns its index'''
+
+        if key in self.rows:
+            index = self.rows[key]
+            for name, value in zip(self.columns, values):
+                self.data[name][index] = value
+            return index
+
+        index = len(self)
+        self.rows[key] = index
+        for name, value in zip(self.columns, values):
+            self.data[name].append(value)
+        return index
+
+
+    def extend(self, columns):
+        '''Appends many rows at once from a dictionary of column name -> values,
+        these rows have no key'''
+
+        for name in self.columns:
+            self.data[name].extend(columns[name])
+
+
+    def row(self, index):
+        return [self.data[name][index] for name in self.columns]
+
+
+    def to_csv(self, file_path):
+        with open(file_path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(self.columns)
+            writer.writerows(zip(*(self.data[name] for name in self.columns)))
+
+
+    def to_parquet(self, file_path):
+        '''Saves the table as parquet, which needs pyarrow'''
+
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("Saving parquet files needs pyarrow, install it with pip install pyarrow")
+
+        arrays = [pa.array(np.asarray(self.data[name]) if len(self) else []) for name in self.columns]
+        pq.write_table(pa.Table.from_arrays(arrays, names=self.columns), file_path)
+
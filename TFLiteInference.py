@@ -0,0 +1,135 @@
+import threading
+import numpy as np
+import tensorflow as tf
+
+# Reduced precision CPU inference for the StarDist network. The Keras network is
+# converted to a TensorFlow Lite flatbuffer once with QuantizeModel.py, and
+# CustomStarDist runs the flatbuffer instead of the Keras model when it is given one.
+# Only the network changes, the thresholding and NMS after it are the same
+
+PRECISIONS = ("float32", "float16", "int8")
+
+
+def configure_threads(intra_op_threads=None, inter_op_threads=None):
+    '''Sets the sizes of TensorFlow's thread pools, None keeps TensorFlow's default.
+    This only works before TensorFlow has run anything, so it is called before the
+    model is loaded'''
+
+    threading_config = tf.config.threading
+    try:
+        # Asking for the sizes already set is fine, such as for a second model in the same process
+        if intra_op_threads is not None and intra_op_threads != threading_config.get_intra_op_parallelism_threads():
+            threading_config.set_intra_op_parallelism_threads(intra_op_threads)
+        if inter_op_threads is not None and inter_op_threads != threading_config.get_inter_op_parallelism_threads():
+            threading_config.set_inter_op_parallelism_threads(inter_op_threads)
+    except RuntimeError as e:
+        print(f"Could not set the TensorFlow thread pools, TensorFlow is already running: {e}")
+
+
+def export_tflite(keras_model, output_path, precision="float16", calibration=None):
+    '''Converts a StarDist Keras network to TensorFlow Lite. float16 stores the weights
+    as float16, int8 quantizes the weights and activations to 8 bits using the value
+    ranges seen on calibration (a list of model inputs). Inputs and outputs stay
+    float32 either way, and the spatial size of the input is left open. Returns the
+    size of the file in bytes'''
+
+    if precision not in PRECISIONS:
+        raise ValueError(f"precision has to be one of {', '.join(PRECISIONS)}")
+    if precision == "int8" and not calibration:
+        raise ValueError("int8 quantization needs calibration images")
+
+    # Converting the Keras 3 model directly fails, a traced function of it converts fine
+    num_channels = keras_model.inputs[0].shape[-1]
+
+    @tf.function(input_signature=[tf.TensorSpec([None, None, None, num_channels], tf.float32)])
+    @tf.autograph.experimental.do_not_convert
+    def network(x):
+        return keras_model(x, training=False)
+
+    converter = tf.lite.TFLiteConverter.from_concrete_functions([network.get_concrete_function()], network)
+    if precision != "float32":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if precision == "float16":
+        converter.target_spec.supported_types = [tf.float16]
+    if precision == "int8":
+        converter.representative_dataset = lambda: ([batch_input(x)] for x in calibration)
+
+    flatbuffer = converter.convert()
+    with open(output_path, 'wb') as f:
+        f.write(flatbuffer)
+
+    return len(flatbuffer)
+
+
+def calibration_inputs(model, file_paths, num_samples=32, crop_size=256, seed=0):
+    '''Random crops of single channels of the images, normalized and laid out like
+    the inputs CustomStarDist gives the network, for int8 calibration. The crops
+    are spread evenly over the images and channels'''
+
+    rng = np.random.default_rng(seed)
+    div_by = max(model.StarDistModel._axes_div_by('YX'))
+
+    samples = []
+    for i, file_path in enumerate(file_paths):
+        img = model.prepare_image(file_path)
+        if img.ndim == 2:
+            img = img[:, :, np.newaxis]
+
+        # The rest of the samples are shared out over the images that are left
+        num_crops = int(np.ceil((num_samples - len(samples)) / (len(file_paths) - i)))
+        size = [max(div_by, min(crop_size, s) // div_by * div_by) for s in img.shape[:2]]
+        for _ in range(num_crops):
+            top = rng.integers(0, img.shape[0] - size[0] + 1)
+            left = rng.integers(0, img.shape[1] - size[1] + 1)
+            channel = rng.integers(0, img.shape[-1])
+            crop = img[top:top + size[0], left:left + size[1]]
+            samples.append(np.array(model.model_input(crop, channel), dtype=np.float32))
+
+    return samples[:num_samples]
+
+
+def batch_input(x):
+    '''A single model input as a batch of one with a channel axis'''
+
+    x = np.asarray(x, dtype=np.float32)
+    if x.ndim == 2:
+        x = x[:, :, np.newaxis]
+    return x[np.newaxis]
+
+
+class TFLiteNetwork:
+    '''Runs an exported network with the TensorFlow Lite interpreter. The interpreter
+    is resized whenever the input shape changes, which is cheap compared to a forward
+    pass and happens once for a folder of same sized images'''
+
+    def __init__(self, model_path, n_rays, num_threads=None):
+        self.model_path = model_path
+        self.interpreter = tf.lite.Interpreter(model_path=model_path, num_threads=num_threads)
+        self.input_index = self.interpreter.get_input_details()[0]['index']
+
+        # The outputs are told apart by their number of channels
+        outputs = {detail['shape_signature'][-1]: detail['index'] for detail in self.interpreter.get_output_details()}
+        self.prob_index = outputs[1]
+        self.dist_index = outputs[n_rays]
+
+        self.input_shape = None
+        # An interpreter can only run one input at a time
+        self.lock = threading.Lock()
+
+
+    def predict(self, batch: np.ndarray):
+        '''Same as keras_model.predict on a (N, H, W, C) batch whose height and width the
+        network can divide, returns the probability and distance maps'''
+
+        batch = np.ascontiguousarray(batch, dtype=np.float32)
+
+        with self.lock:
+            if batch.shape != self.input_shape:
+                self.interpreter.resize_tensor_input(self.input_index, batch.shape)
+                self.interpreter.allocate_tensors()
+                self.input_shape = batch.shape
+
+            self.interpreter.set_tensor(self.input_index, batch)
+            self.interpreter.invoke()
+
+            return self.interpreter.get_tensor(self.prob_index), self.interpreter.get_tensor(self.dist_index)
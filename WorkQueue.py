@@ -0,0 +1,150 @@
+import os
+import time
+import socket
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+# Queue of images shared by several batch mode workers, on one machine or on several
+# nodes with a shared filesystem. Each image is claimed by one worker at a time, and
+# workers keep their claims alive with a heartbeat so the images of a worker that
+# crashed or was killed go back into the queue once its heartbeat is stale.
+# The database uses SQLite's default rollback journal rather than WAL, since WAL
+# does not work across machines. Locking on network filesystems is only as reliable
+# as the filesystem's own file locks
+
+
+class WorkQueue:
+    '''SQLite backed queue of image paths. An image is pending, claimed, done or failed'''
+
+    def __init__(self, db_path, stale_after=600, max_attempts=3):
+        self.db_path = db_path
+        # Seconds without a heartbeat after which a claim is given to another worker
+        self.stale_after = stale_after
+        # Images that were claimed this many times without finishing are marked failed
+        self.max_attempts = max_attempts
+
+        with self.transaction() as db:
+            db.execute("""CREATE TABLE IF NOT EXISTS tasks (
+                              file_path TEXT PRIMARY KEY,
+                              status TEXT NOT NULL DEFAULT 'pending',
+                              worker TEXT,
+                              heartbeat REAL,
+                              attempts INTEGER NOT NULL DEFAULT 0,
+                              error TEXT)""")
+
+
+    @contextmanager
+    def transaction(self):
+        '''Opens a connection and holds the write lock until the block ends. A new
+        connection is used every time so the queue can be used from any thread'''
+
+        db = sqlite3.connect(self.db_path, timeout=60, isolation_level=None)
+        try:
+            # Taking the write lock up front means two workers can never read the
+            # same pending image before either has marked it claimed
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                yield db
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+        finally:
+            db.close()
+
+
+    def add_files(self, file_paths):
+        '''Adds images to the queue, images that are already in it are left as they are
+        so every worker can add the whole folder'''
+
+        with self.transaction() as db:
+            db.executemany("INSERT OR IGNORE INTO tasks (file_path) VALUES (?)",
+                           [(os.path.abspath(file_path),) for file_path in file_paths])
+
+
+    def claim(self, worker_id):
+        '''Claims the next pending image for a worker and returns its path, or None
+        when there is nothing left to claim. Stale claims are recovered first'''
+
+        now = time.time()
+        with self.transaction() as db:
+            db.execute("""UPDATE tasks SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,
+                                           worker = NULL,
+                                           error = 'worker stopped sending heartbeats'
+                          WHERE status = 'claimed' AND heartbeat < ?""",
+                       (self.max_attempts, now - self.stale_after))
+
+            row = db.execute("SELECT file_path FROM tasks WHERE status = 'pending' ORDER BY file_path LIMIT 1").fetchone()
+            if row is None:
+                return None
+
+            db.execute("""UPDATE tasks SET status = 'claimed', worker = ?, heartbeat = ?, attempts = attempts + 1
+                          WHERE file_path = ?""", (worker_id, now, row[0]))
+
+        return row[0]
+
+
+    def heartbeat(self, worker_id, file_path):
+        '''Tells the queue the worker is still working on its claim'''
+
+        with self.transaction() as db:
+            db.execute("UPDATE tasks SET heartbeat = ? WHERE file_path = ? AND worker = ? AND status = 'claimed'",
+                       (time.time(), file_path, worker_id))
+
+
+    def complete(self, worker_id, file_path):
+        with self.transaction() as db:
+            db.execute("UPDATE tasks SET status = 'done', error = NULL WHERE file_path = ? AND worker = ?",
+                       (file_path, worker_id))
+
+
+    def fail(self, worker_id, file_path, error):
+        '''Puts an image that raised an error back in the queue, or marks it failed once
+        it has been tried max_attempts times'''
+
+        with self.transaction() as db:
+            db.execute("""UPDATE tasks SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,
+                                           worker = NULL, error = ?
+                          WHERE file_path = ? AND worker = ?""",
+                       (self.max_attempts, str(error), file_path, worker_id))
+
+
+    def status(self):
+        '''Number of images in every state'''
+
+        with self.transaction() as db:
+            return dict(db.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status").fetchall())
+
+
+    def files(self, status):
+        '''Paths of the images in a state, sorted'''
+
+        with self.transaction() as db:
+            rows = db.execute("SELECT file_path FROM tasks WHERE status = ? ORDER BY file_path", (status,)).fetchall()
+        return [row[0] for row in rows]
+
+
+    @contextmanager
+    def keep_alive(self, worker_id, file_path):
+        '''Sends heartbeats for a claim from a background thread while the block runs'''
+
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(self.stale_after / 4):
+                self.heartbeat(worker_id, file_path)
+
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+
+def default_worker_id():
+    '''Name of this worker in the queue, unique across machines'''
+
+    return f"{socket.gethostname()}:{os.getpid()}"
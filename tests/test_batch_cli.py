@@ -0,0 +1,39 @@
+import sys
+import subprocess
+import pytest
+from conftest import REPO_DIRECTORY
+
+# Batch mode runs on servers without a display or Tk, so nothing it imports may need tkinter.
+# Blocking the module makes any import of it fail
+WITHOUT_TKINTER = '''
+import sys, runpy
+sys.modules["tkinter"] = None
+sys.argv = ["BatchSegment.py", "--help"]
+runpy.run_path("BatchSegment.py", run_name="__main__")
+'''
+
+
+def test_help_without_tkinter():
+    result = subprocess.run([sys.executable, "-c", WITHOUT_TKINTER], cwd=REPO_DIRECTORY,
+                            capture_output=True, text=True, timeout=300)
+
+    assert result.returncode == 0, result.stderr
+    assert "usage: BatchSegment.py" in result.stdout
+
+
+def test_backend_rejects_options_it_does_not_take(tmp_path, capsys):
+    import BatchSegment
+
+    with pytest.raises(SystemExit) as error:
+        BatchSegment.main(["-", str(tmp_path), str(tmp_path / "out"), "--backend", "classical", "--batch-size", "4"])
+
+    assert error.value.code == 2
+    assert "--batch-size is not supported by the classical backend" in capsys.readouterr().err
+
+
+def test_tflite_rejects_tiling_options(tmp_path):
+    import BatchSegment
+
+    with pytest.raises(SystemExit, match="--tflite-model"):
+        BatchSegment.main(["model", str(tmp_path), str(tmp_path / "out"),
+                           "--tflite-model", "model.tflite", "--tile-memory-mb", "256"])
@@ -0,0 +1,82 @@
+import numpy as np
+from skimage.draw import disk
+from skimage.measure import regionprops
+from CellFeatures import cell_features, feature_columns
+
+
+def disk_labels(shape, num_cells, seed):
+    '''Label image of random disks, later cells paint over earlier ones'''
+
+    rng = np.random.default_rng(seed)
+    labels = np.zeros(shape, dtype=np.int32)
+    for label in range(1, num_cells + 1):
+        center = rng.integers(5, shape[0] - 5), rng.integers(5, shape[1] - 5)
+        labels[disk(center, rng.integers(2, 6), shape=shape)] = label
+    return labels
+
+
+def details(num_cells):
+    return dict(points=np.zeros((num_cells, 2), dtype=np.int32), prob=np.full(num_cells, 0.9, dtype=np.float32))
+
+
+def test_matches_regionprops():
+    shape = (70, 90)
+    num_cells = [40, 35, 50]
+    label_images = [disk_labels(shape, n, seed) for seed, n in enumerate(num_cells)]
+    img = np.random.default_rng(9).random(shape + (3,), dtype=np.float32)
+
+    columns = cell_features("image.tif", img, label_images, [details(n) for n in num_cells])
+
+    assert list(columns) == feature_columns(3)
+    assert len(columns["Cell"]) == sum(num_cells)
+
+    row = 0
+    for channel, labels in enumerate(label_images):
+        props = {prop.label: prop for prop in regionprops(labels)}
+        for cell in range(1, num_cells[channel] + 1):
+            assert columns["Channel"][row] == channel + 1 and columns["Cell"][row] == cell
+
+            if cell not in props:
+                # Painted over by later cells
+                assert columns["Area"][row] == 0 and np.isnan(columns["Centroid Y"][row])
+            else:
+                prop = props[cell]
+                assert columns["Area"][row] == prop.area
+                np.testing.assert_allclose([columns["Centroid Y"][row], columns["Centroid X"][row]], prop.centroid, atol=0.005)
+                for other in range(3):
+                    mean = img[:, :, other][prop.coords[:, 0], prop.coords[:, 1]].mean()
+                    np.testing.assert_allclose(columns[f"Mean Intensity {other + 1}"][row], mean, atol=1e-4)
+                    np.testing.assert_allclose(columns[f"Integrated Intensity {other + 1}"][row], mean * prop.area, atol=1e-3)
+            row += 1
+
+
+def test_partner_is_the_largest_overlap():
+    shape = (60, 60)
+    label_images = [disk_labels(shape, 30, seed) for seed in (3, 4)]
+    num_cells = [30, 30]
+
+    columns = cell_features("image.tif", np.zeros(shape + (2,)), label_images, [details(n) for n in num_cells])
+
+    row = 0
+    for channel, labels in enumerate(label_images):
+        other_labels = label_images[1 - channel]
+        for cell in range(1, num_cells[channel] + 1):
+            assert columns[f"Partner {channel + 1}"][row] == cell
+
+            overlaps = np.bincount(other_labels[labels == cell], minlength=2)[1:]
+            partner = columns[f"Partner {2 - channel}"][row]
+            if overlaps.sum() == 0:
+                assert partner == 0 and columns[f"Partner IoU {2 - channel}"][row] == 0
+            else:
+                assert overlaps[partner - 1] == overlaps.max()
+                union = np.count_nonzero((labels == cell) | (other_labels == partner))
+                np.testing.assert_allclose(columns[f"Partner IoU {2 - channel}"][row], overlaps.max() / union, atol=1e-4)
+            row += 1
+
+
+def test_image_without_cells():
+    empty = np.zeros((20, 20), dtype=np.int32)
+
+    columns = cell_features("image.tif", np.zeros((20, 20, 3)), [empty] * 3, [details(0)] * 3)
+
+    assert all(len(values) == 0 for values in columns.values())
@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+from Colocalization import label_overlap, colocalize, colocalization_matrix, colocalization_matrix_blocked
+
+
+def random_labels(shape, num_cells, first_label=1, seed=0):
+    '''Label image of random rectangles numbered from first_label, later ones paint over earlier ones'''
+
+    rng = np.random.default_rng(seed)
+    labels = np.zeros(shape, dtype=np.int32)
+    for label in range(first_label, first_label + num_cells):
+        top, left = rng.integers(0, shape[0] - 4), rng.integers(0, shape[1] - 4)
+        height, width = rng.integers(2, 9, size=2)
+        labels[top:top + height, left:left + width] = label
+    return labels
+
+
+def reference_overlap(labels_a, labels_b):
+    '''Overlap of every pair of labels, one pair at a time'''
+
+    pairs = {}
+    for a in np.unique(labels_a[labels_a > 0]):
+        for b in np.unique(labels_b[labels_a == a]):
+            if b > 0:
+                pairs[int(a), int(b)] = int(np.count_nonzero((labels_a == a) & (labels_b == b)))
+    return pairs
+
+
+def reference_matrix(label_list, min_overlap=1, min_iou=0.0):
+    num_channels = len(label_list)
+    matrix = np.zeros((num_channels, num_channels), dtype=np.int64)
+    for i in range(num_channels):
+        matrix[i, i] = len(np.unique(label_list[i][label_list[i] > 0]))
+        for j in range(num_channels):
+            if i == j:
+                continue
+            matched = set()
+            for (a, b), overlap in reference_overlap(label_list[i], label_list[j]).items():
+                iou = overlap / (np.count_nonzero(label_list[i] == a) + np.count_nonzero(label_list[j] == b) - overlap)
+                if overlap >= min_overlap and iou >= min_iou:
+                    matched.add(a)
+            matrix[i, j] = len(matched)
+    return matrix
+
+
+def test_label_overlap_above_255():
+    labels_a = random_labels((60, 70), 150, first_label=200, seed=1)
+    labels_b = random_labels((60, 70), 150, first_label=70000, seed=2)
+
+    a, b, overlap = label_overlap(labels_a, labels_b)
+
+    assert a.max() > 255 and b.max() > 65535
+    assert dict(zip(zip(a.tolist(), b.tolist()), overlap.tolist())) == reference_overlap(labels_a, labels_b)
+
+
+@pytest.mark.parametrize("min_overlap, min_iou", [(1, 0.0), (4, 0.0), (1, 0.3)])
+def test_matrix_matches_reference(min_overlap, min_iou):
+    label_list = [random_labels((60, 70), 120, first_label=first, seed=seed)
+                  for seed, first in enumerate([1, 300, 1000])]
+
+    expected = reference_matrix(label_list, min_overlap, min_iou)
+
+    np.testing.assert_array_equal(colocalization_matrix(label_list, min_overlap, min_iou), expected)
+    np.testing.assert_array_equal(colocalization_matrix_blocked(label_list, 7, min_overlap, min_iou), expected)
+
+
+def test_empty_masks():
+    empty = np.zeros((30, 40), dtype=np.int32)
+    cells = random_labels((30, 40), 20, first_label=500)
+
+    a, b, overlap = label_overlap(empty, cells)
+    assert len(a) == len(b) == len(overlap) == 0
+    assert colocalize(empty, cells)[0] == 0
+    assert colocalize(cells, empty)[0] == 0
+
+    for label_list in ([empty, empty, empty], [cells, empty, cells]):
+        expected = reference_matrix(label_list)
+        np.testing.assert_array_equal(colocalization_matrix(label_list), expected)
+        np.testing.assert_array_equal(colocalization_matrix_blocked(label_list, 8), expected)
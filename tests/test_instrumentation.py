@@ -0,0 +1,42 @@
+import json
+import threading
+from Instrumentation import Tracer, NULL_SPAN
+
+
+def test_span_records_stage(tmp_path):
+    trace_path = tmp_path / "trace.jsonl"
+    tracer = Tracer(str(trace_path))
+
+    with tracer.span("normalize_image", image="a.tif") as span:
+        span.arrays(normalized=[[0.0, 1.0]])
+    tracer.close()
+
+    record = json.loads(trace_path.read_text())
+    assert record['stage'] == "normalize_image" and record['image'] == "a.tif"
+    assert record['arrays']['normalized']['shape'] == [1, 2]
+    assert record['wall_s'] >= 0 and record['thread_cpu_s'] >= 0
+    assert "normalize_image" in tracer.totals
+
+
+def test_span_finishing_after_close(tmp_path):
+    tracer = Tracer(str(tmp_path / "trace.jsonl"))
+    started, closed = threading.Event(), threading.Event()
+    errors = []
+
+    def prefetch():
+        try:
+            with tracer.span("read_image"):
+                started.set()
+                closed.wait()
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=prefetch)
+    thread.start()
+    started.wait()
+    tracer.close()
+    closed.set()
+    thread.join()
+
+    assert errors == []
+    assert tracer.span("read_image") is NULL_SPAN
@@ -0,0 +1,47 @@
+import os
+import json
+import numpy as np
+import pytest
+import tifffile
+
+pytest.importorskip("stardist")
+
+
+@pytest.fixture(scope="module")
+def model_path(tmp_path_factory):
+    '''A small untrained three channel StarDist model, the results do not matter here'''
+
+    from stardist.models import StarDist2D, Config2D
+
+    base_directory = tmp_path_factory.mktemp("models")
+    config = Config2D(n_rays=16, n_channel_in=3, grid=(2, 2), unet_n_depth=1, unet_n_filter_base=4,
+                      net_conv_after_unet=8)
+    model = StarDist2D(config, name="tiny", basedir=str(base_directory))
+    model.keras_model.save_weights(os.path.join(base_directory, "tiny", "weights_best.weights.h5"))
+    with open(os.path.join(base_directory, "tiny", "thresholds.json"), 'w') as f:
+        json.dump(dict(prob=0.9, nms=0.4), f)
+
+    return os.path.join(base_directory, "tiny")
+
+
+def write_image(directory, height, width):
+    os.makedirs(directory, exist_ok=True)
+    img = np.random.default_rng(0).integers(0, 4000, (3, height, width)).astype(np.uint16)
+    tifffile.imwrite(os.path.join(directory, "image.tif"), img)
+
+
+@pytest.mark.parametrize("height, width, options", [
+    # Smaller than the default block size, segmented whole
+    (120, 150, []),
+    # Larger than the block size along one axis, the block is shrunk to the other
+    (300, 200, ["--block-size", "256"]),
+])
+def test_large_images_on_small_images(tmp_path, model_path, height, width, options):
+    from BatchSegment import main
+
+    write_image(tmp_path / "images", height, width)
+    main([model_path, str(tmp_path / "images"), str(tmp_path / "output"), "--large-images", *options])
+
+    labels = tifffile.imread(tmp_path / "output" / "image_labels.tif")
+    assert labels.shape == (3, height, width)
+    assert (tmp_path / "output" / "colocalization.csv").exists()
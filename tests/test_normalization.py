@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+from csbdeep.utils import normalize
+from Normalization import normalize_percentile, channel_percentiles
+
+
+def random_image(dtype, shape=(64, 80, 3), seed=0):
+    rng = np.random.default_rng(seed)
+    if dtype == np.float32:
+        return rng.normal(100, 30, shape).astype(np.float32)
+    return rng.integers(0, np.iinfo(dtype).max, shape, endpoint=True).astype(dtype)
+
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.uint16, np.float32])
+def test_matches_csbdeep(dtype):
+    img = random_image(dtype)
+
+    result = normalize_percentile(img, 1, 99.8)
+    expected = normalize(img, 1, 99.8, axis=(0, 1))
+
+    assert result.dtype == np.float32
+    np.testing.assert_allclose(result, expected, rtol=0, atol=1e-6)
+
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.uint16])
+def test_histogram_percentiles_match_numpy(dtype):
+    plane = random_image(dtype, shape=(101, 37))
+
+    for percentiles in [(0, 100), (1, 99.8), (50, 50), (3.3, 77.7)]:
+        np.testing.assert_allclose(channel_percentiles(plane, percentiles), np.percentile(plane, percentiles))
+
+
+def test_channel_first_and_single_channel():
+    img = random_image(np.uint16)
+
+    channel_first = normalize_percentile(np.moveaxis(img, -1, 0), channel_axis=0)
+    np.testing.assert_array_equal(channel_first, normalize_percentile(img))
+
+    single = normalize_percentile(img[:, :, 0])
+    assert single.shape == img.shape[:2] + (1,)
+    np.testing.assert_allclose(single[:, :, 0], normalize(img[:, :, 0], 1, 99.8), rtol=0, atol=1e-6)
+
+
+def test_constant_channel_stays_finite():
+    img = np.full((16, 16, 1), 7, dtype=np.uint16)
+
+    assert np.isfinite(normalize_percentile(img)).all()
+
+
+@pytest.mark.parametrize("dtype", [np.uint32, np.uint64])
+def test_wide_integers_do_not_build_a_histogram(dtype):
+    # A histogram would need a bin for every value up to the bright pixel
+    plane = np.zeros((32, 32), dtype=dtype)
+    plane[0, 0] = np.iinfo(dtype).max
+
+    np.testing.assert_allclose(channel_percentiles(plane, (1, 99.8)), np.percentile(plane, (1, 99.8)))
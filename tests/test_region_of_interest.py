@@ -0,0 +1,74 @@
+import numpy as np
+from RegionOfInterest import RegionOfInterest, rectangle, parse_rectangle, crop_windows, inside_any
+
+
+def boxes_overlap(a, b):
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+def covered(windows, shape):
+    mask = np.zeros(shape, dtype=bool)
+    for top, left, bottom, right in windows:
+        mask[top:bottom, left:right] = True
+    return mask
+
+
+def test_padding_is_clipped_to_the_image():
+    windows = crop_windows([rectangle(5, 10, 40, 30)], (100, 120), padding=8)
+
+    assert windows == [(2, 0, 38, 48)]
+
+
+def test_overlapping_windows_are_merged():
+    # The first two only overlap once padded, the third only reaches the box merged from them
+    rois = [rectangle(10, 10, 20, 20), rectangle(24, 24, 36, 36), rectangle(34, 10, 36, 12)]
+
+    windows = crop_windows(rois, (100, 100), padding=4)
+
+    assert windows == [(6, 6, 40, 40)]
+
+
+def test_touching_windows_are_kept_apart():
+    windows = crop_windows([rectangle(10, 10, 20, 20), rectangle(28, 10, 38, 20)], (100, 100), padding=4)
+
+    assert windows == [(6, 6, 24, 24), (6, 24, 24, 42)]
+
+
+def test_windows_never_overlap_and_cover_every_region():
+    rng = np.random.default_rng(0)
+    shape = (300, 400)
+    rois = []
+    for _ in range(25):
+        left, top = rng.integers(0, 380), rng.integers(0, 280)
+        rois.append(rectangle(left, top, left + rng.integers(1, 40), top + rng.integers(1, 40)))
+
+    windows = crop_windows(rois, shape, padding=6, align=8)
+
+    for i in range(len(windows)):
+        for j in range(i + 1, len(windows)):
+            assert not boxes_overlap(windows[i], windows[j])
+
+    mask = covered(windows, shape)
+    for roi in rois:
+        top, left, bottom, right = roi.bounds(shape)
+        assert mask[max(0, top - 6):bottom + 6, max(0, left - 6):right + 6].all()
+
+
+def test_windows_start_on_the_alignment_grid():
+    rois = [rectangle(13, 27, 50, 61), rectangle(201, 99, 230, 140), RegionOfInterest([(300, 5), (340, 60), (290, 70)])]
+
+    for top, left, bottom, right in crop_windows(rois, (256, 360), padding=5, align=16):
+        assert top % 16 == 0 and left % 16 == 0
+        assert bottom <= 256 and right <= 360
+
+
+def test_regions_outside_the_image_are_skipped():
+    assert crop_windows([rectangle(500, 500, 600, 600)], (100, 100), padding=10) == []
+
+
+def test_inside_any_polygon_and_rectangle():
+    triangle = RegionOfInterest([(0, 0), (10, 0), (0, 10)])
+    points = np.array([[1, 1], [8, 8], [25, 25], [40, 40]])
+
+    np.testing.assert_array_equal(inside_any([triangle, parse_rectangle("20,20,30,30")], points),
+                                  [True, False, True, False])
@@ -0,0 +1,89 @@
+import os
+import numpy as np
+from ResultsCache import ResultsCache, fingerprint_files
+
+
+def write_image(path, seed):
+    with open(path, 'wb') as f:
+        f.write(np.random.default_rng(seed).bytes(256))
+
+
+def random_results(seed, shape=(64, 64)):
+    '''Results of a three channel image, the labels are noise so the entries hardly compress'''
+
+    rng = np.random.default_rng(seed)
+    image_list = [rng.integers(0, 2 ** 16, size=shape).astype(np.int32) for _ in range(3)]
+    details_list = [dict(coord=rng.random((5, 2, 16)), points=rng.integers(0, 64, size=(5, 2)), prob=rng.random(5))
+                    for _ in range(3)]
+    return image_list, details_list, rng.integers(0, 5, size=(3, 3))
+
+
+def test_round_trip(tmp_path):
+    cache = ResultsCache(str(tmp_path / "cache"), "settings")
+    write_image(tmp_path / "a.tif", 0)
+    key = cache.image_key(str(tmp_path / "a.tif"))
+    image_list, details_list, matrix = random_results(0)
+
+    assert cache.load(key) is None
+    cache.save(key, image_list, details_list, matrix)
+    cached_images, cached_details, cached_matrix = cache.load(key)
+
+    for labels, cached in zip(image_list, cached_images):
+        np.testing.assert_array_equal(labels, cached)
+    for details, cached in zip(details_list, cached_details):
+        for name in ('coord', 'points', 'prob'):
+            np.testing.assert_array_equal(details[name], cached[name])
+    np.testing.assert_array_equal(matrix, cached_matrix)
+
+
+def test_changed_settings_miss(tmp_path):
+    write_image(tmp_path / "a.tif", 0)
+    cache = ResultsCache(str(tmp_path / "cache"), "prob_thresh=0.5")
+    cache.save(cache.image_key(str(tmp_path / "a.tif")), *random_results(0))
+
+    changed = ResultsCache(str(tmp_path / "cache"), "prob_thresh=0.6")
+    assert changed.load(changed.image_key(str(tmp_path / "a.tif"))) is None
+    # Settings of only this image, like its regions of interest, are part of the key too
+    assert cache.load(cache.image_key(str(tmp_path / "a.tif"), extra="roi")) is None
+    assert cache.load(cache.image_key(str(tmp_path / "a.tif"))) is not None
+
+
+def test_changed_file_misses(tmp_path):
+    cache = ResultsCache(str(tmp_path / "cache"), "settings")
+    write_image(tmp_path / "a.tif", 0)
+    cache.save(cache.image_key(str(tmp_path / "a.tif")), *random_results(0))
+
+    # Same name, new content
+    write_image(tmp_path / "a.tif", 1)
+    assert cache.load(cache.image_key(str(tmp_path / "a.tif"))) is None
+
+
+def test_model_weights_change_fingerprint(tmp_path):
+    write_image(tmp_path / "weights.h5", 0)
+    fingerprint = fingerprint_files([str(tmp_path / "weights.h5")])
+
+    write_image(tmp_path / "weights.h5", 1)
+    assert fingerprint_files([str(tmp_path / "weights.h5")]) != fingerprint
+
+
+def test_least_recently_used_are_evicted(tmp_path):
+    cache = ResultsCache(str(tmp_path / "cache"), "settings")
+    keys = []
+    for seed, name in enumerate("abcd"):
+        write_image(tmp_path / f"{name}.tif", seed)
+        keys.append(cache.image_key(str(tmp_path / f"{name}.tif")))
+
+    for seed, key in enumerate(keys[:3]):
+        cache.save(key, *random_results(seed))
+        # Saved in order a, b, c, some time ago
+        os.utime(cache.entry_path(key), (1000 + seed, 1000 + seed))
+    entry_size = os.path.getsize(cache.entry_path(keys[0]))
+
+    # Reading a makes it the most recently used of the three
+    assert cache.load(keys[0]) is not None
+
+    # Room for two and a half entries, so saving d removes b and c
+    cache.max_size = 2.5 * entry_size
+    cache.save(keys[3], *random_results(3))
+
+    assert [os.path.exists(cache.entry_path(key)) for key in keys] == [True, False, False, True]
@@ -0,0 +1,100 @@
+import os
+import csv
+import json
+from WorkQueue import WorkQueue
+from BatchPipeline import merge_queue_results, QUEUE_RESULTS_FOLDER
+
+
+def make_stale(work_queue, file_path):
+    '''Moves the heartbeat of a claim back past the stale timeout, as if its worker was killed'''
+
+    with work_queue.transaction() as db:
+        db.execute("UPDATE tasks SET heartbeat = heartbeat - ? WHERE file_path = ?",
+                   (work_queue.stale_after + 1, file_path))
+
+
+def test_claim_and_complete(tmp_path):
+    work_queue = WorkQueue(str(tmp_path / "queue.db"))
+    work_queue.add_files([str(tmp_path / "b.tif"), str(tmp_path / "a.tif")])
+    # Adding the folder again, as every worker does, leaves the queue as it is
+    work_queue.add_files([str(tmp_path / "a.tif")])
+
+    first = work_queue.claim("worker-a")
+    second = work_queue.claim("worker-b")
+    assert (first, second) == (str(tmp_path / "a.tif"), str(tmp_path / "b.tif"))
+    assert work_queue.claim("worker-c") is None
+
+    work_queue.complete("worker-a", first)
+    assert work_queue.status() == {'done': 1, 'claimed': 1}
+
+
+def test_heartbeat_keeps_claim(tmp_path):
+    work_queue = WorkQueue(str(tmp_path / "queue.db"), stale_after=60)
+    work_queue.add_files([str(tmp_path / "a.tif")])
+
+    file_path = work_queue.claim("worker-a")
+    make_stale(work_queue, file_path)
+    work_queue.heartbeat("worker-a", file_path)
+
+    assert work_queue.claim("worker-b") is None
+    assert work_queue.files('claimed') == [file_path]
+
+
+def test_stale_claim_is_reclaimed(tmp_path):
+    work_queue = WorkQueue(str(tmp_path / "queue.db"), stale_after=60)
+    work_queue.add_files([str(tmp_path / "a.tif")])
+
+    file_path = work_queue.claim("worker-a")
+    assert work_queue.claim("worker-b") is None
+
+    make_stale(work_queue, file_path)
+    assert work_queue.claim("worker-b") == file_path
+
+    # The first worker no longer owns the image, so its late result is ignored
+    work_queue.complete("worker-a", file_path)
+    assert work_queue.files('claimed') == [file_path]
+    work_queue.complete("worker-b", file_path)
+    assert work_queue.files('done') == [file_path]
+
+
+def test_failed_after_three_attempts(tmp_path):
+    work_queue = WorkQueue(str(tmp_path / "queue.db"), stale_after=60)
+    work_queue.add_files([str(tmp_path / "a.tif")])
+
+    # Two errors put the image back in the queue, a stopped worker counts as an attempt too
+    for worker_id in ("worker-a", "worker-b"):
+        file_path = work_queue.claim(worker_id)
+        work_queue.fail(worker_id, file_path, "out of memory")
+        assert work_queue.files('pending') == [file_path]
+
+    file_path = work_queue.claim("worker-c")
+    make_stale(work_queue, file_path)
+    assert work_queue.claim("worker-d") is None
+    assert work_queue.files('failed') == [file_path]
+
+
+def test_merge_lists_failed_images(tmp_path, capsys):
+    output_directory = tmp_path / "output"
+    os.makedirs(output_directory / QUEUE_RESULTS_FOLDER)
+    work_queue = WorkQueue(str(tmp_path / "queue.db"), max_attempts=1)
+    work_queue.add_files([str(tmp_path / "done.tif"), str(tmp_path / "broken.tif")])
+
+    # The results a worker saves for an image it finished
+    done_path = str(tmp_path / "done.tif")
+    with open(output_directory / QUEUE_RESULTS_FOLDER / "done.json", 'w') as f:
+        json.dump(dict(file_name="done.tif", num_cells=[4, 2, 5],
+                       colocalization_matrix=[[4, 1, 2], [1, 2, 1], [2, 1, 5]]), f)
+    with open(output_directory / QUEUE_RESULTS_FOLDER / "done_cells.csv", 'w', newline='') as f:
+        f.write("file_name,channel,label\ndone.tif,1,1\n")
+
+    broken_path = work_queue.claim("worker-a")
+    work_queue.fail("worker-a", broken_path, "not a tif")
+    assert work_queue.claim("worker-a") == done_path
+    work_queue.complete("worker-a", done_path)
+
+    rows = merge_queue_results(work_queue, str(output_directory))
+
+    assert [row[0] for row in rows] == ["done.tif"]
+    assert "1 images are failed and are not in the table: broken.tif" in capsys.readouterr().out
+    with open(output_directory / "colocalization.csv", newline='') as f:
+        assert [row[0] for row in csv.reader(f)][1:] == ["done.tif"]